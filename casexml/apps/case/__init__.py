@@ -1 +1 @@
-from .xform import process_cases, get_case_updates
+from .xform import process_cases, process_cases_in_batch, get_case_updates
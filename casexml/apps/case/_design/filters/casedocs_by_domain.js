@@ -0,0 +1,12 @@
+/*
+ * Filter that only returns the cases in a domain, passed as the "domain"
+ * query parameter. Deleted docs are also returned since they no longer
+ * have a domain.
+ */
+function(doc, req)
+{
+    return doc["_deleted"] || (
+        (doc["doc_type"] == "CommCareCase" || doc["doc_type"] == "CommCareCase-Deleted") &&
+        doc["domain"] == req.query.domain
+    );
+}
@@ -0,0 +1,104 @@
+"""
+Helpers for making independent database requests at the same time.
+
+Requests are made from a pool of threads (which become greenlets if
+the process is monkey patched by gevent), bounded by the
+CASEXML_FETCH_CONCURRENCY setting.
+"""
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import threading
+from django.db import connection
+from dimagi.utils.chunked import chunked
+from dimagi.utils.couch.database import iter_docs
+from casexml.apps.case import settings
+
+# the pools are created the first time they're needed and shared by every
+# call with the same concurrency
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_concurrency(concurrency):
+    return concurrency if concurrency is not None else settings.CASEXML_FETCH_CONCURRENCY
+
+
+def _get_pool(concurrency):
+    # calls made from a pool's workers get a pool of their own, otherwise
+    # they could wait forever on a pool whose workers are all waiting on them
+    key = (concurrency, getattr(_local, 'depth', 0))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ThreadPool(concurrency)
+        return _pools[key]
+
+
+def _in_worker(func):
+    depth = getattr(_local, 'depth', 0)
+
+    def _call(item):
+        _local.depth = depth + 1
+        try:
+            return func(item)
+        finally:
+            # don't leak the sql connection django opens for each thread
+            connection.close()
+    return _call
+
+
+def concurrent_map(func, items, concurrency=None):
+    """
+    Like map, but makes up to `concurrency` calls at once. Results are
+    returned in the same order as the items and the first exception raised
+    by any call is re-raised.
+    """
+    concurrency = _get_concurrency(concurrency)
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return map(func, items)
+    return _get_pool(concurrency).map(_in_worker(func), items)
+
+
+def run_concurrently(*funcs, **kwargs):
+    """
+    Calls each of the functions, up to `concurrency` at once, and returns
+    a list of their results.
+    """
+    return concurrent_map(lambda func: func(), funcs, **kwargs)
+
+
+def iter_chunks_concurrently(func, items, chunksize=100, concurrency=None):
+    """
+    Splits the items into chunks and calls func (which should return a list)
+    on up to `concurrency` chunks at once, yielding the combined results in
+    order. A new chunk is started as soon as the oldest one is consumed, so
+    only `concurrency` chunks' results are held in memory at a time.
+    """
+    concurrency = _get_concurrency(concurrency)
+    chunks = chunked(items, chunksize)
+    if concurrency <= 1:
+        for chunk in chunks:
+            for result in func(chunk):
+                yield result
+        return
+
+    pool = _get_pool(concurrency)
+    call = _in_worker(func)
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(call, (chunk,)))
+        if len(pending) >= concurrency:
+            for result in pending.popleft().get():
+                yield result
+    while pending:
+        for result in pending.popleft().get():
+            yield result
+
+
+def iter_docs_concurrently(db, doc_ids, chunksize=100, concurrency=None):
+    """
+    Like iter_docs, but fetches up to `concurrency` chunks at once.
+    """
+    return iter_chunks_concurrently(lambda ids: list(iter_docs(db, ids)), doc_ids,
+                                    chunksize=chunksize, concurrency=concurrency)
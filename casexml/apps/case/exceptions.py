@@ -36,6 +36,14 @@ class MissingServerDate(ReconciliationError):
     pass
 
 
+class CaseLockTimeout(CommCareCaseError):
+    """
+    The locks for the cases in a form couldn't be taken in time. The form
+    can be processed again later.
+    """
+    pass
+
+
 class RestoreException(ValueError, CommCareCaseError):
     """
     For stuff that goes wrong during restore
@@ -65,3 +73,28 @@ class BadVersionException(RestoreException):
     Bad ota version
     """
     message = "Bad version number submitted during sync."
+
+
+class RestoreInProgressException(RestoreException):
+    """
+    An identical restore is already being generated
+    """
+    message = "A restore for this account is already in progress. Please try again shortly."
+
+    def __init__(self, retry_after, **kwargs):
+        super(RestoreInProgressException, self).__init__(**kwargs)
+        self.retry_after = retry_after
+
+
+class AsyncRestoreFailedException(RestoreException):
+    """
+    The task generating an async restore failed
+    """
+    message = "There was a problem preparing your restore. Please try again."
+
+
+class AsyncRestoreSupersededException(RestoreException):
+    """
+    The task generating an async restore was replaced by a newer one
+    """
+    message = "The restore was restarted by a newer request."
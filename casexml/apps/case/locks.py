@@ -0,0 +1,104 @@
+import logging
+import time
+import redis
+from casexml.apps.case import settings
+from casexml.apps.case.exceptions import CaseLockTimeout
+from casexml.apps.case.models import CommCareCase
+from casexml.apps.case.signals import case_locks_released
+
+
+class CaseLockManager(object):
+    """
+    Holds the redis locks for the cases being processed.
+
+    Locks are taken in sorted case id order, so two processes locking the
+    same cases can't each hold one the other is waiting for. All the waits
+    share one budget (CASEXML_LOCK_TIMEOUT seconds); once it is used up, or
+    if redis can't be reached, acquire raises CaseLockTimeout so the form
+    can be processed again later. Locks taken by a later call to acquire
+    can't be ordered with the earlier ones, and the budget is what bounds
+    any wait that causes.
+
+    With CASEXML_PROCESS_WITHOUT_LOCKS (or process_without_locks) set, the
+    cases whose locks couldn't be taken are processed without them instead,
+    with a warning. The number of locks, time spent waiting, number of
+    contended locks and number of skipped locks are sent with the
+    case_locks_released signal when the locks are released.
+    """
+    poll_interval = .1
+
+    def __init__(self, timeout=None, process_without_locks=None):
+        self.timeout = settings.CASEXML_LOCK_TIMEOUT if timeout is None else timeout
+        self.process_without_locks = settings.CASEXML_PROCESS_WITHOUT_LOCKS \
+            if process_without_locks is None else process_without_locks
+        self.locks = []
+        self.locked_ids = set()
+        self.deadline = None
+        self.redis_available = True
+        # metrics
+        self.wait_time = 0
+        self.contended = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self, case_ids):
+        """
+        Locks the cases that aren't already locked, in sorted order.
+        """
+        case_ids = sorted(set(case_ids) - self.locked_ids)
+        if self.deadline is None:
+            self.deadline = time.time() + self.timeout
+        for case_id in case_ids:
+            self.locked_ids.add(case_id)
+            lock = self._acquire(case_id) if self.redis_available else None
+            if lock:
+                self.locks.append(lock)
+            else:
+                self.skipped += 1
+
+    def _acquire(self, case_id):
+        lock = CommCareCase.get_obj_lock_by_id(case_id)
+        try:
+            if lock.acquire(blocking=False):
+                return lock
+
+            self.contended += 1
+            start = time.time()
+            try:
+                while time.time() < self.deadline:
+                    time.sleep(self.poll_interval)
+                    if lock.acquire(blocking=False):
+                        return lock
+            finally:
+                self.wait_time += time.time() - start
+            if not self.process_without_locks:
+                raise CaseLockTimeout('timed out waiting for the lock for case %s' % case_id)
+            logging.warning('timed out waiting for the lock for case %s, '
+                            'processing it without the lock' % case_id)
+        except redis.ConnectionError:
+            if not self.process_without_locks:
+                raise CaseLockTimeout('redis unavailable, could not lock case %s' % case_id)
+            logging.warning('redis unavailable, processing cases without locks')
+            self.redis_available = False
+        return None
+
+    def release(self):
+        for lock in self.locks:
+            try:
+                lock.release()
+            except redis.ConnectionError:
+                pass
+        if self.locked_ids:
+            case_locks_released.send(
+                sender=None,
+                num_locks=len(self.locks),
+                wait_time=self.wait_time,
+                contended=self.contended,
+                skipped=self.skipped,
+            )
+        self.locks = []
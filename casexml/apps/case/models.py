@@ -11,7 +11,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from couchdbkit.ext.django.schema import *
-from couchdbkit.exceptions import ResourceNotFound, ResourceConflict
+from couchdbkit.exceptions import ResourceNotFound, ResourceConflict, BulkSaveError
 from PIL import Image
 from casexml.apps.case.exceptions import MissingServerDate, ReconciliationError
 from dimagi.utils.django.cached_object import CachedObject, OBJECT_ORIGINAL, OBJECT_SIZE_MAP, CachedImage, IMAGE_SIZE_ORDERING
@@ -29,6 +29,7 @@ from dimagi.utils.decorators.memoized import memoized
 from dimagi.utils.indicators import ComputedDocumentMixin
 from couchforms.models import XFormInstance
 from casexml.apps.case.sharedmodels import IndexHoldingMixIn, CommCareCaseIndex, CommCareCaseAttachment
+from dimagi.utils.chunked import chunked
 from dimagi.utils.couch.database import SafeSaveDocument, iter_docs
 from dimagi.utils.couch import (
     CouchDocLockableMixIn,
@@ -1015,6 +1016,29 @@ class CommCareCase(SafeSaveDocument, IndexHoldingMixIn, ComputedDocumentMixin,
             self._doc["_rev"] = conflict._rev
             self.force_save()
 
+    @classmethod
+    def bulk_force_save(cls, cases, xforms=()):
+        """
+        Saves the cases with _bulk_docs requests of BULK_SAVE_CHUNK_SIZE docs
+        (plus one more per round of conflicts) and then, once every case has
+        been saved, the forms.
+
+        Cases that conflict are handled the same as force_save: the save
+        fails with ResourceConflict if the conflicting doc has forms that
+        the case doesn't know about, otherwise it is retried against the
+        current revision. Forms are saved as with force_update.
+        """
+        server_modified_on = datetime.utcnow()
+        for case in cases:
+            case.server_modified_on = server_modified_on
+
+        _bulk_force_save(cls.get_db(), cases)
+        for case in cases:
+            case_post_save.send(CommCareCase, case=case)
+
+        if xforms:
+            _bulk_force_save(xforms[0].get_db(), xforms)
+
     def to_xml(self, version):
         from xml.etree import ElementTree
         if self.closed:
@@ -1183,6 +1207,41 @@ class CommCareCaseGroup(Document):
         return data['value'] if data else 0
 
 
+# the most docs to send in one _bulk_docs request
+BULK_SAVE_CHUNK_SIZE = 100
+
+
+def _bulk_force_save(db, docs):
+    for chunk in chunked(docs, BULK_SAVE_CHUNK_SIZE):
+        _bulk_force_save_chunk(db, list(chunk))
+
+
+def _bulk_force_save_chunk(db, docs):
+    while docs:
+        try:
+            db.bulk_save(docs)
+        except BulkSaveError, e:
+            if any(error['error'] != 'conflict' for error in e.errors):
+                raise
+            conflicted_ids = set(error['id'] for error in e.errors)
+            docs = [doc for doc in docs if doc._id in conflicted_ids]
+            current = dict((doc['_id'], doc) for doc in iter_docs(db, conflicted_ids))
+            for doc in docs:
+                if doc._id not in current:
+                    raise ResourceConflict('conflict saving %s' % doc._id)
+                if isinstance(doc, CommCareCase):
+                    missing_forms = set(current[doc._id].get('xform_ids', [])) - set(doc.xform_ids)
+                    if missing_forms:
+                        logging.exception('doc update conflict saving case {id}. missing forms: {forms}'.format(
+                            id=doc._id,
+                            forms=",".join(missing_forms)
+                        ))
+                        raise ResourceConflict('conflict saving case %s' % doc._id)
+                doc._doc["_rev"] = current[doc._id]['_rev']
+        else:
+            docs = []
+
+
 def _action_sort_key_function(case):
     form_ids = list(case.xform_ids)
 
@@ -3,4 +3,22 @@ from django.conf import settings
 try:
     CASEXML_FORCE_DOMAIN_CHECK = settings.CASEXML_FORCE_DOMAIN_CHECK
 except AttributeError:
-    CASEXML_FORCE_DOMAIN_CHECK = False
\ No newline at end of file
+    CASEXML_FORCE_DOMAIN_CHECK = False
+# the number of couch requests that can be made at once when fetching cases
+# in bulk and making independent queries during restores. 1 does everything
+# serially in the calling thread.
+try:
+    CASEXML_FETCH_CONCURRENCY = settings.CASEXML_FETCH_CONCURRENCY
+except AttributeError:
+    CASEXML_FETCH_CONCURRENCY = 1
+# the most seconds processing a form will wait for its case locks in total
+try:
+    CASEXML_LOCK_TIMEOUT = settings.CASEXML_LOCK_TIMEOUT
+except AttributeError:
+    CASEXML_LOCK_TIMEOUT = 30
+# process the cases without their locks, with a warning, if the locks can't
+# be taken in time or redis is unavailable, instead of failing the form
+try:
+    CASEXML_PROCESS_WITHOUT_LOCKS = settings.CASEXML_PROCESS_WITHOUT_LOCKS
+except AttributeError:
+    CASEXML_PROCESS_WITHOUT_LOCKS = False
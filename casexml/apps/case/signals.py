@@ -43,3 +43,8 @@ case_post_save = Signal(providing_args=["case"])
 # place but NOT save them. this is so that we can avoid multiple redundant writes
 # to the database in a row. we may want to revisit this if it creates problems.
 cases_received = Signal(providing_args=["xform", "cases"])
+
+# when the case locks held while processing a form are released, with how many
+# locks were held, the seconds spent waiting for them, how many weren't free
+# on the first try and how many cases were processed without their lock
+case_locks_released = Signal(providing_args=["num_locks", "wait_time", "contended", "skipped"])
@@ -3,12 +3,15 @@ from casexml.apps.case.mock import CaseBlock, CaseBlockError
 
 try:
     from casexml.apps.case.tests.util import delete_all_cases, delete_all_xforms
+    from .test_batch_processing import *
     from .test_bugs import *
+    from .test_concurrency import *
     from .test_dbcache import *
     from .test_exclusion import *
     from .test_force_save import *
     from .test_from_xform import *
     from .test_indexes import *
+    from .test_locks import *
     from .test_multi_case_submits import *
     from .test_multimedia import *
     from .test_ota_restore import *
@@ -0,0 +1,98 @@
+import uuid
+from xml.etree import ElementTree
+from django.test import TestCase
+from mock import patch
+from couchforms.models import XFormInstance
+from couchforms.util import post_xform_to_couch
+from casexml.apps.case import settings, process_cases_in_batch
+from casexml.apps.case.mock import CaseBlock
+from casexml.apps.case.models import CommCareCase
+from casexml.apps.case.signals import cases_received
+from casexml.apps.case.tests.util import delete_all_cases, delete_all_xforms
+from casexml.apps.case.xml import V2
+from casexml.apps.case import xform as xform_processing
+
+
+def _post_unprocessed_form(*case_blocks):
+    form = ElementTree.Element("data")
+    form.attrib['xmlns'] = "https://www.commcarehq.org/test/casexml-wrapper"
+    form.attrib['xmlns:jrm'] = "http://openrosa.org/jr/xforms"
+    for block in case_blocks:
+        form.append(block)
+    return post_xform_to_couch(ElementTree.tostring(form))
+
+
+class BatchProcessingTest(TestCase):
+
+    def setUp(self):
+        settings.CASEXML_FORCE_DOMAIN_CHECK = False
+        delete_all_xforms()
+        delete_all_cases()
+
+    def testMatchesSequentialProcessing(self):
+        case_id = uuid.uuid4().hex
+        create = _post_unprocessed_form(CaseBlock(
+            create=True, case_id=case_id, user_id='batch-user', case_type='household',
+            update={'size': '1'}, version=V2).as_xml())
+        update = _post_unprocessed_form(CaseBlock(
+            create=False, case_id=case_id, update={'size': '2'}, version=V2).as_xml())
+        close = _post_unprocessed_form(CaseBlock(
+            create=False, case_id=case_id, close=True, version=V2).as_xml())
+
+        # applied in the order received
+        [case] = process_cases_in_batch([close, update, create])
+        self.assertEqual(case_id, case._id)
+
+        case = CommCareCase.get(case_id)
+        self.assertEqual('2', case.size)
+        self.assertTrue(case.closed)
+        self.assertEqual([create._id, update._id, close._id], case.xform_ids)
+        for form in (create, update, close):
+            self.assertTrue(XFormInstance.get(form._id).initial_processing_complete)
+
+    def testIndexToCaseCreatedInBatch(self):
+        parent_id, child_id = uuid.uuid4().hex, uuid.uuid4().hex
+        parent = _post_unprocessed_form(CaseBlock(
+            create=True, case_id=parent_id, user_id='batch-user', case_type='household',
+            version=V2).as_xml())
+        child = _post_unprocessed_form(CaseBlock(
+            create=True, case_id=child_id, user_id='batch-user', case_type='member',
+            index={'household': ('household', parent_id)}, version=V2).as_xml())
+
+        cases = process_cases_in_batch([parent, child])
+        self.assertEqual(set([parent_id, child_id]), set(case._id for case in cases))
+        self.assertEqual(parent_id, CommCareCase.get(child_id).indices[0].referenced_id)
+
+    def testCasesReceivedSentOnceOnFallback(self):
+        case_id = uuid.uuid4().hex
+        create = _post_unprocessed_form(CaseBlock(
+            create=True, case_id=case_id, user_id='batch-user', case_type='household',
+            version=V2).as_xml())
+        update = _post_unprocessed_form(CaseBlock(
+            create=False, case_id=case_id, update={'size': '2'}, version=V2).as_xml())
+
+        received = []
+
+        def receiver(sender, xform, cases, **kwargs):
+            received.append(xform._id)
+
+        update_cases = xform_processing._update_cases
+        calls = []
+
+        def fail_second_form(*args, **kwargs):
+            # the second form in the batch fails, after the first was applied
+            calls.append(1)
+            if len(calls) == 2:
+                raise Exception('batch failure')
+            return update_cases(*args, **kwargs)
+
+        cases_received.connect(receiver)
+        try:
+            with patch.object(xform_processing, '_update_cases', fail_second_form):
+                process_cases_in_batch([create, update])
+        finally:
+            cases_received.disconnect(receiver)
+
+        self.assertEqual(4, len(calls))
+        self.assertEqual([create._id, update._id], received)
+        self.assertEqual('2', CommCareCase.get(case_id).size)
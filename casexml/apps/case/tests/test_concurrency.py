@@ -0,0 +1,71 @@
+import threading
+import time
+from django.test import SimpleTestCase
+from casexml.apps.case.concurrency import concurrent_map, run_concurrently, iter_chunks_concurrently
+
+
+class ConcurrencyTest(SimpleTestCase):
+
+    def testOrderPreserved(self):
+        def _slow_square(i):
+            # later items finish first
+            time.sleep((10 - i) * .001)
+            return i * i
+        self.assertEqual([i * i for i in range(10)], concurrent_map(_slow_square, range(10), concurrency=4))
+
+    def testBounded(self):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def _track(i):
+            with lock:
+                running.append(i)
+                max_running.append(len(running))
+            time.sleep(.005)
+            with lock:
+                running.remove(i)
+            return i
+
+        self.assertEqual(range(10), concurrent_map(_track, range(10), concurrency=3))
+        self.assertTrue(max(max_running) <= 3)
+
+    def testSerial(self):
+        threads = concurrent_map(lambda i: threading.current_thread(), range(3), concurrency=1)
+        self.assertEqual([threading.current_thread()] * 3, threads)
+
+    def testExceptions(self):
+        def _fail():
+            raise ValueError('failed')
+        self.assertRaises(ValueError, run_concurrently, lambda: 1, _fail, concurrency=2)
+
+    def testRunConcurrently(self):
+        self.assertEqual([1, 2], run_concurrently(lambda: 1, lambda: 2, concurrency=2))
+
+    def testChunks(self):
+        self.assertEqual(range(25), list(iter_chunks_concurrently(list, range(25), chunksize=4, concurrency=3)))
+
+    def testPoolShared(self):
+        def _thread(i):
+            time.sleep(.005)
+            return threading.current_thread()
+        threads = set(concurrent_map(_thread, range(6), concurrency=2))
+        threads.update(concurrent_map(_thread, range(6), concurrency=2))
+        self.assertTrue(len(threads) <= 2)
+
+    def testNested(self):
+        def _inner(i):
+            return sum(concurrent_map(lambda j: i * j, range(3), concurrency=2))
+        self.assertEqual([3 * i for i in range(4)], concurrent_map(_inner, range(4), concurrency=2))
+
+    def testChunksBounded(self):
+        started = []
+
+        def _chunk(chunk):
+            started.append(chunk[0])
+            return list(chunk)
+
+        results = iter_chunks_concurrently(_chunk, range(20), chunksize=2, concurrency=2)
+        self.assertEqual(0, results.next())
+        self.assertTrue(len(started) <= 3)
+        self.assertEqual(range(1, 20), list(results))
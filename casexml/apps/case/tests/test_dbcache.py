@@ -124,9 +124,22 @@ class CaseDbCacheTest(TestCase):
             self.assertEqual(str(i), case.my_index)
             self.assertTrue(len(case.actions) == 0)
 
+    def testPrefetch(self):
+        case_ids = _make_some_cases(3)
+        missing_id = uuid.uuid4().hex
+        cache = CaseDbCache()
+        cache.prefetch(case_ids + [missing_id])
+        for i, id in enumerate(case_ids):
+            self.assertTrue(cache.in_cache(id))
+            self.assertEqual(str(i), cache.get(id).my_index)
 
+        self.assertFalse(cache.in_cache(missing_id))
+        self.assertEqual(None, cache.get(missing_id))
+        self.assertFalse(cache.doc_exist(missing_id))
 
-
+    def testPrefetchDomainCheck(self):
+        case_ids = _make_some_cases(2, domain='good-domain')
+        self.assertRaises(IllegalCaseId, CaseDbCache(domain='bad-domain').prefetch, case_ids)
 
 
 def _make_some_cases(howmany, domain='dbcache-test'):
@@ -1,7 +1,9 @@
+import uuid
 from django.test import TestCase
 from casexml.apps.case import settings
 from casexml.apps.case.models import CommCareCase
 from couchdbkit.exceptions import ResourceConflict
+from couchforms.models import XFormInstance
 
 class ForceSaveTest(TestCase):
 
@@ -44,3 +46,37 @@ class ForceSaveTest(TestCase):
         # adding should be ok
         conflict.xform_ids = ['f1', 'f2', 'f3', 'f4']
         conflict.force_save()
+
+    def testBulkForceSave(self):
+        settings.CASEXML_FORCE_DOMAIN_CHECK = False
+        unchanged = CommCareCase(foo='unchanged')
+        unchanged.save()
+        original = CommCareCase(xform_ids=['f1'])
+        original.save()
+        conflict = CommCareCase.get(original._id)
+        original.foo = 'bar'
+        original.save()
+
+        conflict.foo = 'not bar'
+        unchanged.foo = 'changed'
+        CommCareCase.bulk_force_save([conflict, unchanged])
+        self.assertEqual('not bar', CommCareCase.get(original._id).foo)
+        self.assertEqual('changed', CommCareCase.get(unchanged._id).foo)
+
+    def testBulkConflictingIdsFail(self):
+        original = CommCareCase(xform_ids=['f1'])
+        original.save()
+        conflict = CommCareCase.get(original._id)
+        original.xform_ids.append('f2')
+        original.save()
+        self.assertRaises(ResourceConflict, CommCareCase.bulk_force_save, [conflict])
+
+    def testBulkFormsNotSavedOnCaseConflict(self):
+        original = CommCareCase(xform_ids=['f1'])
+        original.save()
+        conflict = CommCareCase.get(original._id)
+        original.xform_ids.append('f2')
+        original.save()
+        xform = XFormInstance(_id=uuid.uuid4().hex, form={})
+        self.assertRaises(ResourceConflict, CommCareCase.bulk_force_save, [conflict], [xform])
+        self.assertFalse(XFormInstance.get_db().doc_exist(xform._id))
@@ -1,13 +1,15 @@
 from xml.etree import ElementTree
 import datetime
+from mock import patch
 from casexml.apps.case import settings
 from casexml.apps.case.exceptions import IllegalCaseId
 from casexml.apps.case.mock import CaseBlock
 from casexml.apps.case.models import CommCareCase
 from casexml.apps.case.sharedmodels import CommCareCaseIndex
-from casexml.apps.case.tests.util import check_user_has_case
-from casexml.apps.case.util import post_case_blocks
+from casexml.apps.case.tests.util import check_user_has_case, delete_all_cases
+from casexml.apps.case.util import post_case_blocks, bulk_reverse_indices
 from casexml.apps.case.xml import V2
+from casexml.apps.phone.caselogic import get_related_cases
 from casexml.apps.phone.models import User
 from django.test import TestCase, SimpleTestCase
 from dimagi.utils.parsing import json_format_datetime
@@ -160,3 +162,51 @@ class IndexTest(TestCase):
 
         with self.assertRaisesRegexp(IllegalCaseId, 'Bad case id'):
             post_case_blocks([block.as_xml()], form_extras={'domain': child_domain})
+
+
+class RelatedCasesTest(TestCase):
+
+    def setUp(self):
+        delete_all_cases()
+        # household -> member -> visit, plus a second member
+        self.household_id, self.member_id, self.other_member_id, self.visit_id = \
+            'household-case', 'member-case', 'other-member-case', 'visit-case'
+        post_case_blocks([
+            CaseBlock(create=True, case_id=self.household_id, user_id=USER_ID, version=V2).as_xml(),
+        ])
+        for case_id, parent_id in [(self.member_id, self.household_id),
+                                   (self.other_member_id, self.household_id),
+                                   (self.visit_id, self.member_id)]:
+            post_case_blocks([
+                CaseBlock(create=True, case_id=case_id, user_id=USER_ID,
+                          index={'parent': ('parent-case', parent_id)}, version=V2).as_xml(),
+            ])
+
+    def testSearchUp(self):
+        related = get_related_cases([CommCareCase.get(self.visit_id)], None, search_up=True)
+        self.assertEqual(set([self.visit_id, self.member_id, self.household_id]), set(related))
+
+    def testSearchDown(self):
+        related = get_related_cases([CommCareCase.get(self.household_id)], None, search_up=False)
+        self.assertEqual(set([self.household_id, self.member_id, self.other_member_id, self.visit_id]),
+                         set(related))
+
+    def testMissingCasesFetchedOnce(self):
+        case = CommCareCase.get(self.visit_id)
+        case.indices.append(CommCareCaseIndex(identifier='missing', referenced_type='missing-case',
+                                              referenced_id='missing-case-id'))
+        with patch.object(CommCareCase, 'get') as get, patch.object(CommCareCase, 'get_lite') as get_lite:
+            related = get_related_cases([case], None, search_up=True)
+            self.assertFalse(get.called)
+            self.assertFalse(get_lite.called)
+        self.assertEqual(set([self.visit_id, self.member_id, self.household_id]), set(related))
+
+    def testBulkReverseIndices(self):
+        cases = [CommCareCase.get(case_id) for case_id in (self.household_id, self.member_id, self.visit_id)]
+        reverse = bulk_reverse_indices(CommCareCase.get_db(), cases)
+        for case in cases:
+            self.assertEqual(
+                sorted(index.referenced_id for index in case.reverse_indices),
+                sorted(index.referenced_id for index in reverse[case._id]),
+            )
+        self.assertEqual([], reverse[self.visit_id])
@@ -0,0 +1,93 @@
+from django.test import SimpleTestCase
+from mock import patch
+import redis
+from casexml.apps.case.exceptions import CaseLockTimeout
+from casexml.apps.case.locks import CaseLockManager
+from casexml.apps.case.models import CommCareCase
+from casexml.apps.case.signals import case_locks_released
+
+
+class FakeLock(object):
+    held = set()
+
+    def __init__(self, case_id, acquired):
+        self.case_id = case_id
+        self.acquired = acquired
+
+    def acquire(self, blocking=True):
+        if self.case_id in self.held:
+            return False
+        self.held.add(self.case_id)
+        self.acquired.append(self.case_id)
+        return True
+
+    def release(self):
+        self.held.discard(self.case_id)
+
+
+class CaseLockManagerTest(SimpleTestCase):
+
+    def setUp(self):
+        FakeLock.held = set()
+        self.acquired = []
+        patcher = patch.object(CommCareCase, 'get_obj_lock_by_id',
+                               side_effect=lambda case_id: FakeLock(case_id, self.acquired))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testSortedOrder(self):
+        with CaseLockManager() as manager:
+            manager.acquire(['c', 'a', 'b', 'a'])
+            manager.acquire(['b', 'd'])
+            self.assertEqual(['a', 'b', 'c', 'd'], self.acquired)
+            self.assertEqual(set(['a', 'b', 'c', 'd']), FakeLock.held)
+        self.assertEqual(set(), FakeLock.held)
+
+    def testWaitBudget(self):
+        FakeLock.held = set(['b'])
+        with CaseLockManager(timeout=.05, process_without_locks=False) as manager:
+            manager.poll_interval = .01
+            self.assertRaises(CaseLockTimeout, manager.acquire, ['a', 'b', 'c'])
+            self.assertEqual(['a'], self.acquired)
+            self.assertEqual(1, manager.contended)
+            self.assertTrue(manager.wait_time >= .05)
+        # the locks that were taken are released
+        self.assertEqual(set(['b']), FakeLock.held)
+
+    def testWaitBudgetWithoutLocks(self):
+        FakeLock.held = set(['b'])
+        manager = CaseLockManager(timeout=.05, process_without_locks=True)
+        manager.poll_interval = .01
+        manager.acquire(['a', 'b', 'c'])
+        self.assertEqual(['a', 'c'], self.acquired)
+        self.assertEqual(1, manager.contended)
+        self.assertEqual(1, manager.skipped)
+        self.assertTrue(manager.wait_time >= .05)
+
+    def testRedisUnavailable(self):
+        def _unavailable(blocking=True):
+            raise redis.ConnectionError()
+
+        with patch.object(FakeLock, 'acquire', side_effect=_unavailable):
+            manager = CaseLockManager(process_without_locks=False)
+            self.assertRaises(CaseLockTimeout, manager.acquire, ['a', 'b'])
+
+            manager = CaseLockManager(process_without_locks=True)
+            manager.acquire(['a', 'b'])
+        self.assertEqual(2, manager.skipped)
+        self.assertEqual([], manager.locks)
+
+    def testMetricsSignal(self):
+        received = []
+
+        def _receiver(sender, **kwargs):
+            received.append(kwargs)
+        case_locks_released.connect(_receiver)
+        self.addCleanup(case_locks_released.disconnect, _receiver)
+
+        with CaseLockManager() as manager:
+            manager.acquire(['a', 'b'])
+        [metrics] = received
+        self.assertEqual(2, metrics['num_locks'])
+        self.assertEqual(0, metrics['contended'])
+        self.assertEqual(0, metrics['skipped'])
@@ -6,6 +6,7 @@ from casexml.apps.case.tests import delete_all_xforms, delete_all_cases
 from couchforms.models import XFormInstance
 from couchforms.util import post_xform_to_couch
 from casexml.apps.case import process_cases
+from casexml.apps.case.xform import get_case_updates, extract_case_blocks
 
 
 class MultiCaseTest(TestCase):
@@ -50,6 +51,21 @@ class MultiCaseTest(TestCase):
         self.assertEqual(3, len(cases))
         self._check_ids(form, cases)
 
+    def testCaseUpdatesMemoized(self):
+        file_path = os.path.join(os.path.dirname(__file__), "data", "multicase", "case_in_repeats.xml")
+        with open(file_path, "rb") as f:
+            xml_data = f.read()
+        form = post_xform_to_couch(xml_data)
+        updates = get_case_updates(form)
+        self.assertEqual(3, len(updates))
+        self.assertEqual(len(extract_case_blocks(form)), len(updates))
+        # same form revision, same parsed updates
+        self.assertEqual(updates, get_case_updates(XFormInstance.get(form._id)))
+
+        form.save()
+        self.assertEqual([u.id for u in updates], [u.id for u in get_case_updates(form)])
+        self.assertNotEqual(updates, get_case_updates(form))
+
     def _get_cases(self):
         return CommCareCase.view("case/get_lite", reduce=False, include_docs=True).all()
 
@@ -6,6 +6,7 @@ from casexml.apps.case import const
 from casexml.apps.case.sharedmodels import CommCareCaseIndex
 from casexml.apps.phone.models import SyncLogAssertionError, SyncLog
 from couchforms.models import XFormInstance
+from dimagi.utils.chunked import chunked
 from couchforms.util import create_and_lock_xform
 
 
@@ -95,6 +96,22 @@ def reverse_indices(db, case):
     ).all()
 
 
+def bulk_reverse_indices(db, cases):
+    """
+    Gets the reverse indices of many cases in a single view query.
+    Returns a dict of case id -> list of reverse indices.
+    """
+    ret = dict((case._id, []) for case in cases)
+    for chunk in chunked(cases, 100):
+        rows = db.view("case/related",
+            keys=[[case.domain, case._id, "reverse_index"] for case in chunk],
+            reduce=False,
+        )
+        for row in rows:
+            ret[row['key'][1]].append(CommCareCaseIndex.wrap(row['value']))
+    return ret
+
+
 def primary_actions(case):
     return filter(lambda a: a.action_type != const.CASE_ACTION_REBUILD,
                   case.actions)
@@ -1,20 +1,22 @@
-import copy
+from collections import OrderedDict
 import logging
+import threading
 
 from couchdbkit.resource import ResourceNotFound
-import redis
 from casexml.apps.case.signals import cases_received
 from couchforms.models import XFormInstance
-from dimagi.utils.chunked import chunked
 from casexml.apps.case.exceptions import (
+    CaseLockTimeout,
     IllegalCaseId,
     NoDomainProvided,
     ReconciliationError,
 )
 from casexml.apps.case import settings
 from dimagi.utils.couch.database import iter_docs
+from casexml.apps.case.concurrency import iter_chunks_concurrently, iter_docs_concurrently
 
 from casexml.apps.case import const
+from casexml.apps.case.locks import CaseLockManager
 from casexml.apps.case.models import CommCareCase
 from casexml.apps.case.xml.parser import case_update_from_block
 from casexml.apps.phone.models import SyncLog
@@ -36,7 +38,124 @@ def process_cases(xform, config=None):
         return _process_cases(xform, config, case_db)
 
 
+def process_cases_in_batch(xforms, config=None):
+    """
+    Processes the cases in a sequence of forms, e.g. when replaying a
+    backlog, with the same end result as calling process_cases on each
+    form in the order they were received.
+
+    The forms' updates are applied in received_on order to one in-memory
+    copy of each case, so a case that is updated by many forms is only
+    loaded and saved once. The cases for each domain are locked and loaded
+    up front, each sync log is saved once, and the cases and forms are
+    written with bulk requests. If applying the updates fails (including
+    any sync log assertion) nothing has been saved yet, and the forms are
+    processed one at a time instead. cases_received is only sent for the
+    forms once the batch has been saved, so each form is signalled once
+    either way.
+
+    Returns the cases that were updated.
+    """
+    config = config or CaseProcessingConfig()
+    xforms_by_domain = OrderedDict()
+    for xform in sorted(xforms, key=lambda xform: xform.received_on):
+        xforms_by_domain.setdefault(get_and_check_xform_domain(xform), []).append(xform)
+
+    cases = []
+    for domain, domain_xforms in xforms_by_domain.items():
+        with CaseDbCache(domain=domain, lock=True) as case_db:
+            try:
+                updated_cases, sync_logs, received = _update_cases_in_batch(
+                    domain_xforms, config, case_db)
+            except CaseLockTimeout:
+                # processing the forms one at a time would wait for the locks again
+                raise
+            except Exception:
+                logging.exception('batch case processing failed for %s forms in domain %s, '
+                                  'processing them one at a time' % (len(domain_xforms), domain))
+                updated_cases = None
+            else:
+                for sync_log in sync_logs:
+                    if config.reconcile:
+                        sync_log.reconcile_cases()
+                    sync_log.invalidate_cached_payloads()
+                    sync_log.save()
+                _save_cases_and_forms(updated_cases, domain_xforms)
+                for xform, xform_cases in received:
+                    _send_cases_received(xform, xform_cases)
+                cases.extend(updated_cases)
+
+        if updated_cases is None:
+            # nothing has been saved and the locks have been released
+            updated_cases = OrderedDict()
+            for xform in domain_xforms:
+                for case in process_cases(xform, config):
+                    updated_cases[case._id] = case
+            cases.extend(updated_cases.values())
+    return cases
+
+
 def _process_cases(xform, config, case_db):
+    cases = _update_cases(xform, config, case_db)
+
+    # handle updating the sync records for apps that use sync mode
+    last_sync_token = getattr(xform, 'last_sync_token', None)
+    if last_sync_token:
+        relevant_log = SyncLog.get(last_sync_token)
+        # in reconciliation mode, things can be unexpected
+        relevant_log.strict = config.strict_asserts
+        from casexml.apps.case.util import update_sync_log_with_checks
+        update_sync_log_with_checks(relevant_log, xform, cases,
+                                    case_id_blacklist=config.case_id_blacklist)
+
+        if config.reconcile:
+            relevant_log.reconcile_cases()
+            relevant_log.save()
+
+    _send_cases_received(xform, cases)
+    _save_cases_and_forms(cases, [xform])
+    return cases
+
+
+def _update_cases_in_batch(xforms, config, case_db):
+    """
+    Applies all the forms' updates to the cases and sync logs in memory,
+    returning the updated cases, the sync logs and the (form, cases) pairs
+    to send cases_received for once they've been saved.
+    """
+    # lock and load every case the batch refers to at once
+    case_db.prefetch(case_id
+                     for xform in xforms
+                     for case_id in _get_referenced_case_ids(get_case_updates(xform)))
+
+    updated_cases = OrderedDict()
+    sync_logs = {}
+    received = []
+    for xform in xforms:
+        cases = _update_cases(xform, config, case_db)
+
+        last_sync_token = getattr(xform, 'last_sync_token', None)
+        if last_sync_token:
+            if last_sync_token not in sync_logs:
+                sync_logs[last_sync_token] = SyncLog.get(last_sync_token)
+                sync_logs[last_sync_token].strict = config.strict_asserts
+            # unlike process_cases, don't try to fix up the log if this fails
+            # since that writes. the SyncLogAssertionError fails the batch
+            # and the forms are processed one at a time instead
+            sync_logs[last_sync_token].update_phone_lists(xform, cases, save=False)
+
+        received.append((xform, cases))
+        for case in cases:
+            updated_cases[case._id] = case
+
+    return updated_cases.values(), sync_logs.values(), received
+
+
+def _update_cases(xform, config, case_db):
+    """
+    Applies the form's case blocks to the cases in the case_db and returns
+    the updated cases. Doesn't save anything.
+    """
     cases = get_or_update_cases(xform, case_db).values()
 
     if config.reconcile:
@@ -56,21 +175,10 @@ def _process_cases(xform, config, case_db):
 
         cases = [attach_extras(case) for case in cases]
 
-    # handle updating the sync records for apps that use sync mode
-
-    last_sync_token = getattr(xform, 'last_sync_token', None)
-    if last_sync_token:
-        relevant_log = SyncLog.get(last_sync_token)
-        # in reconciliation mode, things can be unexpected
-        relevant_log.strict = config.strict_asserts
-        from casexml.apps.case.util import update_sync_log_with_checks
-        update_sync_log_with_checks(relevant_log, xform, cases,
-                                    case_id_blacklist=config.case_id_blacklist)
+    return cases
 
-        if config.reconcile:
-            relevant_log.reconcile_cases()
-            relevant_log.save()
 
+def _send_cases_received(xform, cases):
     try:
         cases_received.send(sender=None, xform=xform, cases=cases)
     except Exception as e:
@@ -81,22 +189,23 @@ def _process_cases(xform, config, case_db):
             'for form %s: %s' % (xform._id, e)
         )
 
+
+def _save_cases_and_forms(cases, xforms):
     for case in cases:
         if not case.check_action_order():
             try:
                 case.reconcile_actions(rebuild=True)
             except ReconciliationError:
                 pass
-        case.force_save()
 
     # set flags for indicator pillows and save
-    xform.initial_processing_complete = True
+    for xform in xforms:
+        xform.initial_processing_complete = True
     # if there are pillows or other _changes listeners competing to update
-    # this form, override them. this will create a new entry in the feed
+    # these forms, override them. this will create a new entry in the feed
     # that they can re-pick up on
-    xform.save(force_update=True)
-
-    return cases
+    # the forms are only saved once all of the cases have been
+    CommCareCase.bulk_force_save(cases, xforms)
 
 
 class CaseProcessingConfig(object):
@@ -126,18 +235,16 @@ class CaseDbCache(object):
         self.strip_history = strip_history
         self.deleted_ok = deleted_ok
         self.lock = lock
-        self.locks = []
+        self.lock_manager = CaseLockManager() if lock else None
+        # ids that were prefetched but don't exist
+        self.not_found = set()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for lock in self.locks:
-            if lock:
-                try:
-                    lock.release()
-                except redis.ConnectionError:
-                    pass
+        if self.lock_manager:
+            self.lock_manager.release()
 
     def validate_doc(self, doc):
         if self.domain and doc.domain != self.domain:
@@ -156,17 +263,15 @@ class CaseDbCache(object):
             raise IllegalCaseId('case_id must not be empty')
         if case_id in self.cache:
             return self.cache[case_id]
+        if case_id in self.not_found:
+            return None
 
         try:
             if self.strip_history:
                 case_doc = CommCareCase.get_lite(case_id)
             elif self.lock:
-                try:
-                    case_doc, lock = CommCareCase.get_locked_obj(_id=case_id)
-                except redis.ConnectionError:
-                    case_doc = CommCareCase.get(case_id)
-                else:
-                    self.locks.append(lock)
+                self.lock_manager.acquire([case_id])
+                case_doc = CommCareCase.get(case_id)
             else:
                 case_doc = CommCareCase.get(case_id)
         except ResourceNotFound:
@@ -180,25 +285,46 @@ class CaseDbCache(object):
         self.cache[case_id] = case
         
     def doc_exist(self, case_id):
+        if case_id in self.not_found:
+            return False
         return case_id in self.cache or CommCareCase.get_db().doc_exist(case_id)
 
     def in_cache(self, case_id):
         return case_id in self.cache
 
-    def populate(self, case_ids):
+    def _iter_raw_cases(self, case_ids):
+        if self.strip_history:
+            def _get_lite(ids):
+                return [row['value'] for row in
+                        CommCareCase.get_db().view("case/get_lite", keys=ids, include_docs=False)]
+            return iter_chunks_concurrently(_get_lite, case_ids)
+        else:
+            return iter_docs_concurrently(CommCareCase.get_db(), case_ids)
 
-        def _iter_raw_cases(case_ids):
-            if self.strip_history:
-                for ids in chunked(case_ids, 100):
-                    for row in CommCareCase.get_db().view("case/get_lite", keys=ids, include_docs=False):
-                        yield row['value']
-            else:
-                for raw_case in iter_docs(CommCareCase.get_db(), case_ids):
-                    yield raw_case
+    def populate(self, case_ids):
+        for raw_case in self._iter_raw_cases(case_ids):
+            case = CommCareCase.wrap(raw_case)
+            self.set(case._id, case)
 
-        for raw_case in  _iter_raw_cases(case_ids):
+    def prefetch(self, case_ids):
+        """
+        Like calling get for each of the case ids, but with one bulk request
+        instead of a request per case. If this cache locks, all the cases
+        are locked first, in sorted order.
+        """
+        case_ids = sorted(set(case_id for case_id in case_ids if case_id)
+                          - set(self.cache) - self.not_found)
+        if not case_ids:
+            return
+
+        if self.lock and not self.strip_history:
+            self.lock_manager.acquire(case_ids)
+
+        for raw_case in self._iter_raw_cases(case_ids):
             case = CommCareCase.wrap(raw_case)
+            self.validate_doc(case)
             self.set(case._id, case)
+        self.not_found.update(case_id for case_id in case_ids if case_id not in self.cache)
 
 
 def get_and_check_xform_domain(xform):
@@ -221,6 +347,12 @@ def get_or_update_cases(xform, case_db):
     """
     case_updates = get_case_updates(xform)
 
+    # load everything the form refers to up front rather than one case at a time
+    case_db.prefetch(_get_referenced_case_ids(case_updates))
+
+    # only the cases the form updates, not the index targets that are
+    # also in the cache
+    touched_cases = {}
     for case_update in case_updates:
         case_doc = _get_or_update_model(case_update, xform, case_db)
         if case_doc:
@@ -229,16 +361,13 @@ def get_or_update_cases(xform, case_db):
             if xform._id not in case_doc.xform_ids:
                 case_doc.xform_ids.append(xform.get_id)
             case_db.set(case_doc.case_id, case_doc)
+            touched_cases[case_doc.case_id] = case_doc
         else:
             logging.error(
                 "XForm %s had a case block that wasn't able to create a case! "
                 "This usually means it had a missing ID" % xform.get_id
             )
 
-    # at this point we know which cases we want to update so sopy this away
-    # this prevents indices that end up in the cache from being added to the return value
-    touched_cases = copy.copy(case_db.cache)
-
     # once we've gotten through everything, validate all indices
     def _validate_indices(case):
         if case.indices:
@@ -253,11 +382,27 @@ def get_or_update_cases(xform, case_db):
                          "database is corrupt and you should restore your "
                          "phone directly from the server.") % index.referenced_id)
 
-    [_validate_indices(case) for case in case_db.cache.values()]
+    # the cases' existing indices can point at cases that weren't in the form
+    case_db.prefetch(index.referenced_id
+                     for case in touched_cases.values()
+                     for index in case.indices)
+    [_validate_indices(case) for case in touched_cases.values()]
 
     return touched_cases
 
 
+def _get_referenced_case_ids(case_updates):
+    """
+    The ids of the cases and index targets in a form's case updates
+    """
+    for case_update in case_updates:
+        yield case_update.id
+        index_action = case_update.get_index_action()
+        if index_action:
+            for index in index_action.indices:
+                yield index.referenced_id
+
+
 def _get_or_update_model(case_update, xform, case_db):
     """
     Gets or updates an existing case, based on a block of data in a
@@ -327,15 +472,47 @@ def _extract_case_blocks(data):
                 for case_block in case_blocks:
                     if has_case_id(case_block):
                         yield case_block
-            else:
+            elif isinstance(value, (dict, list)):
+                # anything else is an attribute or text, which can't
+                # contain case blocks
                 for case_block in _extract_case_blocks(value):
                     yield case_block
     else:
         return
 
 
+# the parsed case updates of recently seen forms, by form id and revision
+_case_updates_cache = OrderedDict()
+_case_updates_cache_lock = threading.Lock()
+CASE_UPDATES_CACHE_SIZE = 100
+
+
 def get_case_updates(xform):
-    return [case_update_from_block(cb) for cb in extract_case_blocks(xform)]
+    """
+    The CaseUpdates for the case blocks in a form.
+
+    For saved XFormInstances these are only parsed once per revision of
+    the form (for the last CASE_UPDATES_CACHE_SIZE forms), so don't modify
+    them.
+    """
+    if not isinstance(xform, XFormInstance) or not xform._doc.get('_rev'):
+        return [case_update_from_block(cb) for cb in extract_case_blocks(xform)]
+
+    key = (xform._id, xform._doc['_rev'])
+
+    with _case_updates_cache_lock:
+        case_updates = _case_updates_cache.pop(key, None)
+        if case_updates is not None:
+            # most recently used goes last
+            _case_updates_cache[key] = case_updates
+            return list(case_updates)
+
+    case_updates = [case_update_from_block(cb) for cb in extract_case_blocks(xform)]
+    with _case_updates_cache_lock:
+        _case_updates_cache[key] = case_updates
+        while len(_case_updates_cache) > CASE_UPDATES_CACHE_SIZE:
+            _case_updates_cache.popitem(last=False)
+    return list(case_updates)
 
 
 def get_case_ids_from_form(xform):
@@ -0,0 +1,12 @@
+// Emit the sync token of every modification to a case, keyed by domain and
+// date so that the modifications since a sync can be found with one range query
+function (doc) {
+    if (doc.doc_type === 'CommCareCase') {
+        var actions = doc.actions;
+        for (var i = 0; i < actions.length; i += 1) {
+            if (actions[i]['server_date']) {
+                emit([doc.domain, actions[i]['server_date'], doc._id], actions[i]['sync_log_id']);
+            }
+        }
+    }
+}
@@ -0,0 +1,233 @@
+import hashlib
+import tempfile
+import uuid
+from django.db.models import Max
+from dimagi.utils.chunked import chunked
+from casexml.apps.case.models import CommCareCase
+from casexml.apps.phone import xml
+from casexml.apps.phone.caselogic import get_changed_case_ids
+from casexml.apps.phone.models import CaseState
+from casexml.apps.stock.models import StockTransaction
+
+
+class CaseXMLCache(object):
+    """
+    A cache of serialized restore case blocks.
+
+    Entries are keyed on the case's version token, the CaseXML version and
+    the set of updates being sent, so a case that hasn't been modified
+    can reuse the block generated by any earlier restore instead of being
+    rendered again. Any cache object with the django cache api (get_many
+    and set_many) can be used as the backend.
+    """
+    timeout = 24 * 60 * 60
+    chunksize = 100
+
+    def __init__(self, cache, version):
+        self.cache = cache
+        self.version = version
+
+    def get_key(self, case, updates):
+        return hashlib.md5('case-xml-{token}-{version}-{updates}'.format(
+            token=case.get_version_token(),
+            version=self.version,
+            updates=','.join(sorted(updates)),
+        )).hexdigest()
+
+    def iter_case_xml(self, sync_updates):
+        """
+        Yields the serialized case block for each CaseSyncUpdate in order,
+        from the cache where possible.
+        """
+        for chunk in chunked(sync_updates, self.chunksize):
+            keys = [self.get_key(op.case, op.required_updates) for op in chunk]
+            cached = self.cache.get_many(keys)
+            missing = {}
+            for key, op in zip(keys, chunk):
+                if key in cached:
+                    yield cached[key]
+                else:
+                    case_xml = xml.get_case_xml(op.case, op.required_updates, self.version)
+                    missing[key] = case_xml
+                    yield case_xml
+            if missing:
+                self.cache.set_many(missing, self.timeout)
+
+
+class _MissingChunk(Exception):
+    pass
+
+
+class RestoreCaseCache(object):
+    """
+    A cache of the case portion of an initial restore: the case states for
+    the new sync log and the serialized case and ledger blocks.
+
+    For an initial restore these only depend on the domain and the owner ids,
+    so an entry is shared by every user with the same owner ids (e.g. all the
+    members of a group). This assumes the restore's stock settings are the
+    same for all of those users.
+
+    The case states and blocks are stored in chunks of chunksize under
+    their own keys, so no single cache value grows with the size of the
+    restore. The blocks are cached by cache_blocks as the restore streams
+    them, and the entry is only saved by set once all of them have been.
+    Restores with more than max_size bytes of blocks aren't cached.
+
+    An entry is only used while it is fresh: no case in it can have changed
+    in the domain's _changes feed since it was created, no other changed
+    case can be open and owned by one of the owners, and no stock
+    transaction can have been added to its cases.
+    """
+    timeout = 60 * 60
+    # past this many changed cases or stock transactions don't bother
+    # checking them
+    max_changes = 1000
+    chunksize = 100
+    max_size = 20 * 1024 * 1024
+
+    STATES = ('cases_on_phone', 'dependent_cases_on_phone')
+    BLOCKS = ('case_xml', 'ledger_xml')
+
+    def __init__(self, cache, domain, owner_ids, version):
+        self.cache = cache
+        self.domain = domain
+        self.owner_ids = set(owner_ids)
+        self.version = version
+        # the entry being written by cache_blocks and set
+        self._token = uuid.uuid4().hex
+        self._chunk_counts = dict((name, 0) for name in self.STATES + self.BLOCKS)
+        self._block_counts = {}
+        self._size = 0
+
+    def get_key(self):
+        return hashlib.md5('restore-cases-{domain}-{version}-{owner_ids}'.format(
+            domain=self.domain,
+            version=self.version,
+            owner_ids=','.join(sorted(self.owner_ids)),
+        )).hexdigest()
+
+    def _get_chunk_key(self, token, name, index):
+        return hashlib.md5('restore-cases-chunk-{token}-{name}-{index}'.format(
+            token=token,
+            name=name,
+            index=index,
+        )).hexdigest()
+
+    def _set_chunk(self, name, chunk):
+        index = self._chunk_counts[name]
+        self.cache.set(self._get_chunk_key(self._token, name, index), chunk, self.timeout)
+        self._chunk_counts[name] = index + 1
+
+    def _iter_chunks(self, entry, name):
+        for index in range(entry['chunks'][name]):
+            chunk = self.cache.get(self._get_chunk_key(entry['token'], name, index))
+            if chunk is None:
+                raise _MissingChunk()
+            yield chunk
+
+    def _get_blocks_file(self, entry, name):
+        blocks = tempfile.TemporaryFile()
+        try:
+            for chunk in self._iter_chunks(entry, name):
+                blocks.write(chunk)
+        except _MissingChunk:
+            blocks.close()
+            raise
+        blocks.seek(0)
+        return blocks
+
+    def get(self):
+        """
+        Returns the cached entry if there's a fresh one, as a dict with the
+        case states under 'cases_on_phone' and 'dependent_cases_on_phone',
+        temporary files with the serialized blocks under 'case_xml' and
+        'ledger_xml', and the number of blocks in each under 'counts'.
+        """
+        entry = self.cache.get(self.get_key())
+        if entry is None:
+            return None
+        ret = {'counts': entry['counts']}
+        try:
+            for name in self.STATES:
+                ret[name] = [state for chunk in self._iter_chunks(entry, name) for state in chunk]
+            if not self._is_fresh(entry, ret['cases_on_phone'] + ret['dependent_cases_on_phone']):
+                return None
+            for name in self.BLOCKS:
+                ret[name] = self._get_blocks_file(entry, name)
+        except _MissingChunk:
+            # part of the entry has been evicted
+            for name in self.BLOCKS:
+                if name in ret:
+                    ret[name].close()
+            return None
+        for name in self.STATES:
+            ret[name] = [CaseState.wrap(state) for state in ret[name]]
+        return ret
+
+    def cache_blocks(self, name, blocks):
+        """
+        Yields the serialized blocks, caching them in chunks as they go by.
+        """
+        count = 0
+        for chunk in chunked(blocks, self.chunksize):
+            for block in chunk:
+                yield block
+            count += len(chunk)
+            if self._size is not None:
+                self._size += sum(len(block) for block in chunk)
+                if self._size > self.max_size:
+                    # too big to cache, don't store any more of it
+                    self._size = None
+                else:
+                    self._set_chunk(name, ''.join(chunk))
+        self._block_counts[name] = count
+
+    def set(self, last_seq, ledger_watermark, cases_on_phone, dependent_cases_on_phone):
+        """
+        Caches the case portion of a restore once all its blocks have gone
+        through cache_blocks. last_seq and ledger_watermark should be read
+        before any of it is computed.
+        """
+        if self._size is None or set(self._block_counts) != set(self.BLOCKS):
+            return
+        for name, states in zip(self.STATES, (cases_on_phone, dependent_cases_on_phone)):
+            for chunk in chunked(states, self.chunksize):
+                self._set_chunk(name, [state.to_json() for state in chunk])
+        self.cache.set(self.get_key(), {
+            'token': self._token,
+            'last_seq': last_seq,
+            'ledger_watermark': ledger_watermark,
+            'chunks': dict(self._chunk_counts),
+            'counts': dict(self._block_counts),
+        }, self.timeout)
+
+    @staticmethod
+    def get_ledger_watermark():
+        """
+        The id of the latest stock transaction. Any transaction added after
+        it has a higher id.
+        """
+        return StockTransaction.objects.aggregate(Max('pk'))['pk__max'] or 0
+
+    def _is_fresh(self, entry, states):
+        case_ids = set(state['case_id'] for state in states)
+        changed_case_ids = get_changed_case_ids(entry['last_seq'], limit=self.max_changes + 1,
+                                                domain=self.domain)
+        if len(changed_case_ids) > self.max_changes or changed_case_ids & case_ids:
+            return False
+
+        # any of the other changed cases could have been given to the owners
+        if changed_case_ids:
+            owned_case_ids = set(row['id'] for row in CommCareCase.get_db().view(
+                'case/by_owner',
+                keys=[[owner_id, False] for owner_id in self.owner_ids],
+                reduce=False,
+            ))
+            if changed_case_ids & owned_case_ids:
+                return False
+
+        ledger_case_ids = set(StockTransaction.objects.filter(
+            pk__gt=entry['ledger_watermark'],
+        ).values_list('case_id', flat=True)[:self.max_changes + 1])
+        return len(ledger_case_ids) <= self.max_changes and not (ledger_case_ids & case_ids)
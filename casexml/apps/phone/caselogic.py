@@ -1,14 +1,20 @@
 """
 Logic about chws phones and cases go here.
 """
-from collections import defaultdict
 from datetime import datetime
 import itertools
 import logging
 from casexml.apps.case.models import CommCareCase
 from casexml.apps.case import const
+from casexml.apps.case.util import bulk_reverse_indices
+from casexml.apps.case.concurrency import iter_docs_concurrently, run_concurrently
 from casexml.apps.case.xform import CaseDbCache
+from casexml.apps.phone.models import CaseState
+from dimagi.utils.decorators.memoized import memoized
 
+# past this many modifications in a domain since a sync it's cheaper to
+# look the modifications up for each case
+MAX_DOMAIN_MODIFICATIONS = 10000
 
 def get_related_cases(initial_case_list, domain, strip_history=False, search_up=True):
     """
@@ -25,23 +31,34 @@ def get_related_cases(initial_case_list, domain, strip_history=False, search_up=
                           strip_history=strip_history,
                           deleted_ok=True)
 
-    def related(case_db, case):
-        return [case_db.get(index.referenced_id) for index in (case.indices if search_up else case.reverse_indices)]
+    def indices(cases):
+        if search_up:
+            return dict((case.case_id, case.indices) for case in cases)
+        return bulk_reverse_indices(CommCareCase.get_db(), cases)
 
     relevant_cases = {}
     relevant_deleted_case_ids = []
 
-    queue = list(case for case in initial_case_list)
-    directly_referenced_indices = itertools.chain(*[[index.referenced_id for index in (case.indices if search_up else case.reverse_indices)]
-                                                    for case in initial_case_list])
-    case_db.populate(directly_referenced_indices)
-    while queue:
-        case = queue.pop()
-        if case and case.case_id not in relevant_cases:
-            relevant_cases[case.case_id] = case
-            if case.doc_type == 'CommCareCase-Deleted':
-                relevant_deleted_case_ids.append(case.case_id)
-            queue.extend(related(case_db, case))
+    # walk the index graph a level at a time, fetching each level's
+    # cases in bulk rather than making a request per referenced case
+    level = list(initial_case_list)
+    while level:
+        new_cases = []
+        for case in level:
+            if case and case.case_id not in relevant_cases:
+                relevant_cases[case.case_id] = case
+                if case.doc_type == 'CommCareCase-Deleted':
+                    relevant_deleted_case_ids.append(case.case_id)
+                new_cases.append(case)
+
+        referenced_ids = []
+        for case_indices in indices(new_cases).values():
+            referenced_ids.extend(index.referenced_id for index in case_indices
+                                  if index.referenced_id not in relevant_cases)
+        # prefetch validates the cases and remembers the ones that don't
+        # exist, so the gets below don't go back to the database
+        case_db.prefetch(referenced_ids)
+        level = [case_db.get(case_id) for case_id in referenced_ids]
 
     if relevant_deleted_case_ids:
         logging.error('deleted cases included in footprint (restore): %s' % (
@@ -83,10 +100,7 @@ class CaseSyncOperation(object):
     """
     
     def __init__(self, user, last_sync):
-        try:
-            keys = [[owner_id, False] for owner_id in user.get_owner_ids()]
-        except AttributeError:
-            keys = [[user.user_id, False]]
+        keys = [[owner_id, False] for owner_id in _get_owner_ids(user)]
 
         def _user_case_domain_match(case):
             if user.domain:
@@ -98,55 +112,188 @@ class CaseSyncOperation(object):
         #       cases the server thinks are the phone's, footprint of those) 
         # intersected with:
         # (cases modified by someone else since the last sync)
-        
-        # TODO: clean this up. Basically everything is a set of cases,
-        # but in order to do proper comparisons we use IDs so all of these
-        # operations look much more complicated than they should be.
 
-        self.actual_owned_cases = set(filter(_user_case_domain_match,
-                                             CommCareCase.view("case/by_owner_lite", keys=keys).all()))
-        self._all_relevant_cases = get_footprint(self.actual_owned_cases, domain=user.domain)
-        
-        def _to_case_id_set(cases):
-            return set([c.case_id for c in cases])
-        
-        def _get_case(case_id):
-            if case_id in self._all_relevant_cases:
-                return self._all_relevant_cases[case_id]
-            else:
-                case = CommCareCase.get_with_rebuild(case_id)
-                self._all_relevant_cases[case_id] = case
-                return case
-
-        self.actual_relevant_cases = set(self._all_relevant_cases.values())
-        
-        
-        self.actual_extended_cases = set([_get_case(case_id) for case_id in \
-                                          _to_case_id_set(self.actual_relevant_cases) - \
-                                          _to_case_id_set(self.actual_owned_cases)])
-        
-        self.phone_relevant_cases = set([_get_case(case_id) for case_id \
-                                         in last_sync.get_footprint_of_cases_on_phone()]) \
-                                    if last_sync else set()
-        
-        self.all_potential_cases = set([_get_case(case_id) for case_id in \
-                                        _to_case_id_set(self.actual_relevant_cases) | \
-                                        _to_case_id_set(self.phone_relevant_cases)])
-        
-        self.all_potential_to_sync = filter_cases_modified_elsewhere_since_sync(
-            list(self.all_potential_cases), last_sync)
-        
-        # this is messy but forces uniqueness at the case_id level, without
-        # having to reload all the cases from the DB
-        self.all_potential_to_sync_dict = dict((case.get_id, case) \
-                                               for case in self.all_potential_to_sync)
-        
+        # all of this is worked out on case ids. documents are only needed
+        # for the owned and extended cases (which are already loaded) and
+        # for whatever ends up being synced.
+        def _get_owned_cases_and_footprint():
+            owned_cases = set(filter(_user_case_domain_match,
+                                     CommCareCase.view("case/by_owner_lite", keys=keys).all()))
+            return owned_cases, get_footprint(owned_cases, domain=user.domain)
+
+        def _get_modified_case_ids():
+            # with a domain this doesn't depend on the cases so it can be
+            # looked up at the same time as them
+            if last_sync and user.domain:
+                return _get_case_ids_modified_since(user.domain, last_sync)
+
+        (self.actual_owned_cases, self._all_relevant_cases), modified_case_ids = run_concurrently(
+            _get_owned_cases_and_footprint,
+            _get_modified_case_ids,
+        )
+
+        owned_case_ids = set(case.case_id for case in self.actual_owned_cases)
+        self.actual_relevant_case_ids = set(self._all_relevant_cases)
+        self.actual_extended_cases = set(self._all_relevant_cases[case_id] for case_id in
+                                         self.actual_relevant_case_ids - owned_case_ids)
+
+        self.phone_relevant_case_ids = last_sync.get_footprint_of_cases_on_phone() \
+                                       if last_sync else set()
+        self.all_potential_case_ids = self.actual_relevant_case_ids | self.phone_relevant_case_ids
+        if modified_case_ids is not None:
+            self.all_potential_to_sync_ids = _filter_relevant_case_ids(
+                self.all_potential_case_ids, modified_case_ids, last_sync)
+        else:
+            # either there's no domain or it had too many modifications to
+            # go through, so look them up for each case
+            self.all_potential_to_sync_ids = filter_case_ids_modified_elsewhere_since_sync(
+                self.all_potential_case_ids, last_sync)
+
         self.actual_cases_to_sync = []
-        for _, case in self.all_potential_to_sync_dict.items():
+        for case in self._get_cases(self.all_potential_to_sync_ids):
             sync_update = CaseSyncUpdate(case, last_sync)
             if sync_update.required_updates:
                 self.actual_cases_to_sync.append(sync_update)
 
+    def _get_cases(self, case_ids):
+        """
+        Gets the cases for a set of ids, using the footprint where possible
+        and fetching any others in bulk.
+        """
+        cases = dict((case_id, self._all_relevant_cases[case_id]) for case_id in case_ids
+                     if case_id in self._all_relevant_cases)
+        missing_ids = set(case_ids) - set(cases)
+        for raw_case in iter_docs_concurrently(CommCareCase.get_db(), missing_ids):
+            cases[raw_case['_id']] = CommCareCase.wrap(raw_case)
+        # anything not found may still need to be rebuilt
+        for case_id in missing_ids - set(cases):
+            cases[case_id] = CommCareCase.get_with_rebuild(case_id)
+        self._all_relevant_cases.update(cases)
+        return cases.values()
+
+    # the sets of cases the sync operation used to keep. the operation
+    # itself only needs the ids, so these are only loaded when asked for
+
+    @property
+    @memoized
+    def actual_relevant_cases(self):
+        return set(self._get_cases(self.actual_relevant_case_ids))
+
+    @property
+    @memoized
+    def phone_relevant_cases(self):
+        return set(self._get_cases(self.phone_relevant_case_ids))
+
+    @property
+    @memoized
+    def all_potential_cases(self):
+        return set(self._get_cases(self.all_potential_case_ids))
+
+    @property
+    @memoized
+    def all_potential_to_sync(self):
+        return self._get_cases(self.all_potential_to_sync_ids)
+
+    @property
+    def all_potential_to_sync_dict(self):
+        return dict((case.get_id, case) for case in self.all_potential_to_sync)
+
+    def get_owned_case_states(self):
+        return [CaseState.from_case(case) for case in self.actual_owned_cases]
+
+    def get_extended_case_states(self):
+        return [CaseState.from_case(case) for case in self.actual_extended_cases]
+
+
+class IncrementalCaseSyncOperation(object):
+    """
+    A sync operation that works out what has changed since the last sync
+    from the _changes feed, rather than by looking at every case the user
+    owns. The owned cases and footprint are carried forward from the last
+    sync log and only cases that have changed since its last_seq are loaded.
+
+    Use get_incremental_case_updates to create one.
+    """
+    # past this many changed cases a full sync is cheaper
+    max_changes = 10000
+
+    def __init__(self, user, last_sync, changed_case_ids):
+        self.changed_case_ids = changed_case_ids
+        case_db = CaseDbCache(domain=user.domain, strip_history=True, deleted_ok=True)
+        case_db.populate(changed_case_ids)
+        # hard deleted cases won't come back from the db
+        self._cases = dict((case_id, case_db.cache[case_id]) for case_id in changed_case_ids
+                           if case_db.in_cache(case_id))
+
+        owner_ids = set(_get_owner_ids(user))
+
+        def _is_owned(case):
+            return (case.doc_type == 'CommCareCase' and not case.closed
+                    and (case.owner_id or case.user_id) in owner_ids
+                    and (not user.domain or user.domain == case.domain))
+
+        # unchanged cases are in the same state they were in at the last
+        # sync, so their indices can come from the sync log
+        indices = dict((state.case_id, state.indices) for state in
+                       itertools.chain(last_sync.cases_on_phone, last_sync.dependent_cases_on_phone)
+                       if state.case_id not in changed_case_ids)
+        indices.update((case_id, case.indices) for case_id, case in self._cases.items())
+
+        self.actual_owned_case_ids = set(
+            state.case_id for state in last_sync.cases_on_phone
+            if state.case_id not in changed_case_ids
+        ) | set(case_id for case_id, case in self._cases.items() if _is_owned(case))
+
+        # walk the footprint a level at a time, only loading cases that
+        # weren't on the phone before
+        self.actual_relevant_case_ids = set()
+        level = set(self.actual_owned_case_ids)
+        while level:
+            self.actual_relevant_case_ids.update(level)
+            unknown_ids = set(case_id for case_id in level if case_id not in indices)
+            case_db.populate(unknown_ids)
+            for case_id in unknown_ids:
+                if case_db.in_cache(case_id):
+                    self._cases[case_id] = case_db.cache[case_id]
+                    indices[case_id] = self._cases[case_id].indices
+                else:
+                    # cases that can't be found are left out
+                    self.actual_relevant_case_ids.remove(case_id)
+            level = set(index.referenced_id for case_id in level for index in indices.get(case_id, [])
+                        if index.referenced_id) - self.actual_relevant_case_ids
+        self._indices = indices
+
+        phone_case_ids = last_sync.get_footprint_of_cases_on_phone()
+        all_potential_case_ids = self.actual_relevant_case_ids | phone_case_ids
+        # unchanged cases the phone already has can't have been modified elsewhere
+        self.all_potential_to_sync_ids = filter_case_ids_modified_elsewhere_since_sync(
+            (all_potential_case_ids & changed_case_ids) | (self.actual_relevant_case_ids - phone_case_ids),
+            last_sync,
+            user.domain,
+        )
+
+        missing_ids = self.all_potential_to_sync_ids - set(self._cases)
+        case_db.populate(missing_ids)
+        self._cases.update((case_id, case_db.cache[case_id]) for case_id in missing_ids
+                           if case_db.in_cache(case_id))
+
+        self.actual_cases_to_sync = []
+        for case_id in self.all_potential_to_sync_ids:
+            if case_id in self._cases:
+                sync_update = CaseSyncUpdate(self._cases[case_id], last_sync)
+                if sync_update.required_updates:
+                    self.actual_cases_to_sync.append(sync_update)
+
+    def _get_case_states(self, case_ids):
+        return [CaseState(case_id=case_id, indices=self._indices.get(case_id, []))
+                for case_id in case_ids]
+
+    def get_owned_case_states(self):
+        return self._get_case_states(self.actual_owned_case_ids)
+
+    def get_extended_case_states(self):
+        return self._get_case_states(self.actual_relevant_case_ids - self.actual_owned_case_ids)
+
 def get_case_updates(user, last_sync):
     """
     Given a user, get the open/updated cases since the last sync 
@@ -155,48 +302,134 @@ def get_case_updates(user, last_sync):
     """
     return CaseSyncOperation(user, last_sync)
 
-def filter_cases_modified_elsewhere_since_sync(cases, last_sync):
-    # this function is pretty ugly and is heavily optimized to reduce the number
-    # of queries to couch.
+def get_incremental_case_updates(user, last_sync):
+    """
+    Like get_case_updates, but only looks at cases that have changed since
+    the last sync. Returns None if that isn't possible, in which case a
+    full sync is needed.
+    """
+    if not last_sync or not last_sync.last_seq:
+        return None
+    if set(_get_owner_ids(user)) != set(last_sync.owner_ids_on_phone):
+        # cases may have come into or out of scope without being modified
+        return None
+    changed_case_ids = get_changed_case_ids(
+        last_sync.last_seq,
+        limit=IncrementalCaseSyncOperation.max_changes + 1,
+        domain=user.domain,
+    )
+    if len(changed_case_ids) > IncrementalCaseSyncOperation.max_changes:
+        return None
+    return IncrementalCaseSyncOperation(user, last_sync, changed_case_ids)
+
+def get_changed_case_ids(since, limit=None, domain=None):
+    """
+    The ids of all cases that have changed since a database sequence number,
+    from the _changes feed. With a domain, only the cases in that domain
+    (and any hard deleted docs) are included.
+    """
+    if domain:
+        params = {'since': since, 'filter': 'case/casedocs_by_domain', 'domain': domain}
+    else:
+        params = {'since': since, 'filter': 'case/casedocs'}
+    if limit:
+        params['limit'] = limit
+    results = CommCareCase.get_db().res.get('_changes', **params).json_body['results']
+    return set(row['id'] for row in results)
+
+def _get_owner_ids(user):
+    try:
+        return user.get_owner_ids()
+    except AttributeError:
+        return [user.user_id]
+
+def filter_cases_modified_elsewhere_since_sync(cases, last_sync, domain=None):
+    case_ids = filter_case_ids_modified_elsewhere_since_sync(
+        [case._id for case in cases], last_sync, domain)
+    return [case for case in cases if case._id in case_ids]
+
+def filter_case_ids_modified_elsewhere_since_sync(case_ids, last_sync, domain=None):
+    """
+    Filters case ids down to the ones that have been modified by someone
+    other than the phone since the last sync, or that the phone doesn't have.
+
+    If the domain is known and hasn't had too many modifications since the
+    sync they're found with a single range query on the dates, otherwise
+    they're looked up for every case.
+    """
+    case_ids = set(case_ids)
     if not last_sync:
-        return cases
+        return case_ids
     else:
-        case_ids = [case._id for case in cases]
-        case_log_map = CommCareCase.get_db().view('phone/cases_to_sync_logs',
-            keys=case_ids,
-            reduce=False,
-        )
+        modified_ids = _get_case_ids_modified_since(domain, last_sync) if domain else None
+        if modified_ids is None:
+            modified_ids = _get_case_ids_modified_by_case(case_ids, last_sync)
+        return _filter_relevant_case_ids(case_ids, modified_ids, last_sync)
+
+def _filter_relevant_case_ids(case_ids, modified_ids, last_sync):
+    phone_case_ids = last_sync.get_footprint_of_cases_on_phone()
+
+    def relevant(case_id):
+        return case_id in modified_ids or case_id not in phone_case_ids
+
+    return set(filter(relevant, case_ids))
+
+def _modified_elsewhere_since_sync(date, token, last_sync):
+    return date >= last_sync.date and token != last_sync._id
+
+def _get_case_ids_modified_since(domain, last_sync, limit=None):
+    """
+    Gets the ids of the cases in a domain modified elsewhere since the last
+    sync, or None if there are more than limit modifications to go through.
+    """
+    if limit is None:
+        limit = MAX_DOMAIN_MODIFICATIONS
+    # the dates in the view only go down to the second, so start at the
+    # beginning of the last sync's second and compare the rest exactly
+    rows = CommCareCase.get_db().view('phone/case_modifications_by_date',
+        startkey=[domain, last_sync.date.strftime('%Y-%m-%dT%H:%M:%S')],
+        endkey=[domain, {}],
+        limit=limit + 1,
+    ).all()
+    if len(rows) > limit:
+        return None
+    # incoming format is a list of objects that look like this:
+    # {
+    #   'value': '[sync token id]',
+    #   'key': ['[domain]', '2012-08-22T08:55:14Z', '[case id]'],
+    # }
+    return set(
+        row['key'][2] for row in rows
+        if _modified_elsewhere_since_sync(
+            datetime.strptime(row['key'][1], '%Y-%m-%dT%H:%M:%SZ'), row['value'], last_sync)
+    )
+
+def _get_case_ids_modified_by_case(case_ids, last_sync):
+    # this function is pretty ugly and is heavily optimized to reduce the number
+    # of queries to couch.
+    case_log_map = CommCareCase.get_db().view('phone/cases_to_sync_logs',
+        keys=list(case_ids),
+        reduce=False,
+    )
+    # incoming format is a list of objects that look like this:
+    # {
+    #   'value': '[log id]',
+    #   'key': '[case id]',
+    # }
+    unique_combinations = set((row['key'], row['value']) for row in case_log_map)
+    modification_dates = CommCareCase.get_db().view('phone/case_modification_status',
+        keys=[list(combo) for combo in unique_combinations],
+        reduce=True,
+        group=True,
+    )
+    modified_ids = set()
+    for row in modification_dates:
         # incoming format is a list of objects that look like this:
         # {
-        #   'value': '[log id]',
-        #   'key': '[case id]',
+        #   'value': '2012-08-22T08:55:14Z', (most recent date updated)
+        #   'key': ['[case id]', '[sync token id]']
         # }
-        unique_combinations = set((row['key'], row['value']) for row in case_log_map)
-        modification_dates = CommCareCase.get_db().view('phone/case_modification_status',
-            keys=[list(combo) for combo in unique_combinations],
-            reduce=True,
-            group=True,
-        )
-        # we'll build a structure that looks like this for efficiency:
-        # { case_id: [{'token': '[token value', 'date': '[date value]'}, ...]}
-        all_case_updates_by_sync_token = defaultdict(lambda: [])
-        for row in modification_dates:
-            # incoming format is a list of objects that look like this:
-            # {
-            #   'value': '2012-08-22T08:55:14Z', (most recent date updated)
-            #   'key': ['[case id]', '[sync token id]']
-            # }
-            if row['value']:
-                all_case_updates_by_sync_token[row['key'][0]].append(
-                    {'token': row['key'][1], 'date': datetime.strptime(row['value'], '%Y-%m-%dT%H:%M:%SZ')}
-                )
-
-        def case_modified_elsewhere_since_sync(case):
-            # NOTE: uses closures
-            return any([row['date'] >= last_sync.date and row['token'] != last_sync._id
-                        for row in all_case_updates_by_sync_token[case._id]])
-
-        def relevant(case):
-            return case_modified_elsewhere_since_sync(case) or not last_sync.phone_is_holding_case(case.get_id)
-
-        return filter(relevant, cases)
+        if row['value'] and _modified_elsewhere_since_sync(
+                datetime.strptime(row['value'], '%Y-%m-%dT%H:%M:%SZ'), row['key'][1], last_sync):
+            modified_ids.add(row['key'][0])
+    return modified_ids
@@ -1,6 +1,5 @@
 import hashlib
 import binascii
-from copy import copy
 
 
 EMPTY_HASH = ""
@@ -44,6 +43,16 @@ class Checksum(object):
     >>> Checksum().hexdigest()
     ''
 
+    The digests are XOR-ed together as 128-bit integers, which gives the
+    same result as XOR-ing them byte by byte
+
+    >>> ids = ['abc123', '123abc', 'some-case', u'another-case']
+    >>> Checksum(ids).hexdigest() == binascii.hexlify(str(reduce(Checksum.xor, map(Checksum.hash, ids))))
+    True
+
+    >>> Checksum(['a', 'a']).hexdigest()
+    '00000000000000000000000000000000'
+
     """
 
     def __init__(self, init=None):
@@ -61,11 +70,41 @@ class Checksum(object):
         assert(len(bytes1) == len(bytes2))
         return bytearray([b1 ^ b2 for (b1, b2) in zip(bytes1, bytes2)])
 
+    @classmethod
+    def update_hexdigest(cls, hexdigest, changed_ids):
+        """
+        Given the hexdigest of a list of ids, get the hexdigest of that list
+        with each of changed_ids added (or removed, if it was already
+        there). Since the checksum is an XOR of the individual hashes
+        this only needs to hash the ids that changed.
+
+        >>> Checksum.update_hexdigest(Checksum(['abc123']).hexdigest(), ['123abc'])
+        '409c5c597fa2c2a693b769f0d2ad432b'
+
+        >>> Checksum.update_hexdigest('409c5c597fa2c2a693b769f0d2ad432b', ['123abc'])
+        'e99a18c428cb38d5f260853678922e03'
+
+        >>> Checksum(['abc123']).hexdigest()
+        'e99a18c428cb38d5f260853678922e03'
+
+        """
+        x = int(hexdigest, 16) if hexdigest else 0
+        for id in changed_ids:
+            x ^= Checksum.int_hash(id)
+        return Checksum.int_to_hexdigest(x)
+
+    @classmethod
+    def int_hash(cls, line):
+        return int(hashlib.md5(line).hexdigest(), 16)
+
+    @classmethod
+    def int_to_hexdigest(cls, value):
+        return '%032x' % value
+
     def hexdigest(self):
         if not self._list:
             return EMPTY_HASH
-        x = copy(self._list)
-        x = map(Checksum.hash, x)
-        x = reduce(Checksum.xor, x)
-        x = binascii.hexlify(str(x))
-        return x
+        x = 0
+        for id in self._list:
+            x ^= Checksum.int_hash(id)
+        return Checksum.int_to_hexdigest(x)
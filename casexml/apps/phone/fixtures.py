@@ -1,7 +1,37 @@
+from casexml.apps.case.concurrency import concurrent_map
 from casexml.apps.case.xml import V1
+from casexml.apps.phone import xml
 from django.conf import settings
 from dimagi.utils.modules import to_function
+import hashlib
 import itertools
+import logging
+import time
+
+
+def cached_fixture(cache_key, timeout=60 * 60, skip_unchanged=False):
+    """
+    Decorator for fixture generators whose output can be cached.
+
+    cache_key should be a function taking the same arguments as the
+    generator (user, version, last_sync) and returning a string that
+    identifies the generator's output, e.g. the domain, fixture id and a
+    version of the data, or None if it shouldn't be cached.
+
+    If skip_unchanged is set the fixture is left out of restores for phones
+    that got it with the same key at their last sync. Only use this for
+    fixtures the phone keeps when they're not sent.
+    """
+    def decorator(func):
+        func.cache_key = cache_key
+        func.cache_timeout = timeout
+        func.skip_unchanged = skip_unchanged
+        return func
+    return decorator
+
+
+def _get_name(func):
+    return '%s.%s' % (func.__module__, func.__name__)
 
 
 class FixtureGenerator(object):
@@ -22,9 +52,19 @@ class FixtureGenerator(object):
     func(user, version, last_sync) --> [list of fixture objects]
     
     The function should return an empty list if there are no fixtures
+
+    Generators decorated with cached_fixture have their serialized output
+    cached (see get_serialized_fixtures).
+
+    Generators can be run concurrently (in a pool of threads) by setting
+    FIXTURE_GENERATOR_CONCURRENCY to the number that can run at once.
+    The fixtures are always returned in the order of FIXTURE_GENERATORS.
     """
+    # generators that take longer than this many seconds get logged
+    slow_threshold = 1
 
     def __init__(self):
+        self.concurrency = getattr(settings, "FIXTURE_GENERATOR_CONCURRENCY", 1)
         self._generator_funcs = []
         if hasattr(settings, "FIXTURE_GENERATORS"):
             for func_path in settings.FIXTURE_GENERATORS:
@@ -36,10 +76,90 @@ class FixtureGenerator(object):
         """
         Gets all fixtures associated with an OTA restore operation
         """
+        fixtures, _ = self.get_fixtures_with_timings(user, version, last_sync)
+        return fixtures
+
+    def get_fixtures_with_timings(self, user, version, last_sync=None):
+        """
+        Like get_fixtures, but also returns how long each generator took
+        as a list of (generator name, seconds) in generator order.
+        """
         if version == V1: 
-            return []  # V1 phones will never use or want fixtures
-        return itertools.chain(*[func(user, version, last_sync)
-                                 for func in self._generator_funcs])
+            return [], []  # V1 phones will never use or want fixtures
+
+        results, timings = self._run_generators(
+            lambda func: list(func(user, version, last_sync)), user
+        )
+        return list(itertools.chain(*results)), timings
+
+    def get_serialized_fixtures(self, user, version, last_sync=None, cache=None):
+        """
+        Gets the fixtures for a restore already serialized, using the cache
+        for generators that declare a cache key.
+
+        Returns the list of serialized fixtures and a dict of generator
+        name -> cache key for the cached generators, which should be saved
+        on the new sync log.
+        """
+        fixtures, cache_keys, _ = self.get_serialized_fixtures_with_timings(
+            user, version, last_sync, cache)
+        return fixtures, cache_keys
+
+    def get_serialized_fixtures_with_timings(self, user, version, last_sync=None, cache=None):
+        """
+        Like get_serialized_fixtures, but also returns how long each
+        generator took as a list of (generator name, seconds) in generator
+        order.
+        """
+        if version == V1:
+            return [], {}, []  # V1 phones will never use or want fixtures
+
+        cache_keys = {}
+
+        def _generate(func):
+            key = func.cache_key(user, version, last_sync) \
+                if getattr(func, 'cache_key', None) else None
+            if key is None:
+                return [xml.tostring(fixture) for fixture in func(user, version, last_sync)]
+
+            name = _get_name(func)
+            cache_keys[name] = key
+            if func.skip_unchanged and last_sync and last_sync.fixture_cache_keys.get(name) == key:
+                return []
+
+            cache_key = hashlib.md5('fixture-{name}-{version}-{key}'.format(
+                name=name, version=version, key=key,
+            )).hexdigest()
+            fixtures = cache.get(cache_key) if cache else None
+            if fixtures is None:
+                fixtures = [xml.tostring(fixture) for fixture in func(user, version, last_sync)]
+                if cache:
+                    cache.set(cache_key, fixtures, func.cache_timeout)
+            return fixtures
+
+        results, timings = self._run_generators(_generate, user)
+        return list(itertools.chain(*results)), cache_keys, timings
+
+    def _run_generators(self, generate, user):
+        """
+        Calls generate(func) for each generator, concurrently if configured.
+        Returns the results in generator order and a list of
+        (generator name, seconds) timings.
+        """
+        def _timed(func):
+            start = time.time()
+            result = generate(func)
+            return result, time.time() - start
 
+        results = concurrent_map(_timed, self._generator_funcs, self.concurrency)
+        timings = []
+        for func, (_, duration) in zip(self._generator_funcs, results):
+            name = _get_name(func)
+            if duration > self.slow_threshold:
+                logging.warning('fixture generator %s took %.2fs for user %s' % (
+                    name, duration, user.user_id
+                ))
+            timings.append((name, duration))
+        return [result for result, _ in results], timings
 
 generator = FixtureGenerator()
@@ -1,3 +1,4 @@
+from collections import defaultdict
 from copy import copy
 from couchdbkit.exceptions import ResourceConflict, ResourceNotFound
 from couchdbkit.ext.django.schema import *
@@ -6,7 +7,7 @@ from dimagi.utils.mixins import UnicodeMixIn
 from dimagi.utils.couch import LooselyEqualDocumentSchema
 from casexml.apps.case import const
 from casexml.apps.case.sharedmodels import CommCareCaseIndex, IndexHoldingMixIn
-from casexml.apps.phone.checksum import Checksum, CaseStateHash
+from casexml.apps.phone.checksum import Checksum, CaseStateHash, EMPTY_HASH
 import logging
 
 
@@ -61,6 +62,16 @@ class CaseState(LooselyEqualDocumentSchema, IndexHoldingMixIn):
         return cls(case_id=case.get_id,
                    indices=case.indices)
 
+    def update_indices(self, index_update_list):
+        old_referenced_ids = [index.referenced_id for index in self.indices]
+        super(CaseState, self).update_indices(index_update_list)
+        # states that came from a sync log let it know, so that it can
+        # update what it has worked out from the indices
+        sync_log = getattr(self, '_sync_log', None)
+        if sync_log is not None:
+            sync_log._case_state_indices_changed(
+                old_referenced_ids, [index.referenced_id for index in self.indices])
+
     def __repr__(self):
         return "case state: %s (%s)" % (self.case_id, self.indices)
 
@@ -98,6 +109,15 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
     # as well as all groups that that user is a member of.
     owner_ids_on_phone = StringListProperty()
 
+    # running checksum of the case ids in the footprint, kept up to date
+    # as cases are added to and removed from the phone lists so that the
+    # state hash doesn't need to be recomputed on every sync. None when it
+    # has to be recomputed. see get_state_hash
+    footprint_hash = StringProperty()
+
+    # generator name -> cache key of the cacheable fixtures sent in this sync
+    fixture_cache_keys = DictProperty()
+
     strict = True  # for asserts
 
     def get_payload_attachment_name(self, version):
@@ -120,6 +140,10 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
         for name in copy(self._doc.get('_attachments', {})):
             self.delete_attachment(name)
 
+    def save(self, *args, **kwargs):
+        self._check_footprint_hash()
+        super(SyncLog, self).save(*args, **kwargs)
+
     def _assert(self, conditional, msg="", case_id=None):
         if not conditional:
             if self.strict:
@@ -136,6 +160,8 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
         ret = super(SyncLog, cls).wrap(data)
         if hasattr(ret, 'has_assert_errors'):
             ret.strict = False
+        if ret.footprint_hash is not None:
+            ret._hashed_lists = ret._get_case_lists_signature()
         return ret
 
     @classmethod
@@ -156,6 +182,105 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
             self._previous_log_ref = SyncLog.get(self.previous_log_id) if self.previous_log_id else None
         return self._previous_log_ref
 
+    def _get_list_signature(self, *list_names):
+        # identifies the current state of the case state lists for
+        # the purposes of the cached lookups below. any replacement of a
+        # list or change in its size produces a different signature.
+        return [(self._doc[name], len(self._doc[name])) for name in list_names]
+
+    @staticmethod
+    def _signature_matches(signature, other):
+        return all(list1 is list2 and len1 == len2
+                   for (list1, len1), (list2, len2) in zip(signature, other))
+
+    def _get_case_lists_signature(self):
+        return self._get_list_signature('cases_on_phone', 'dependent_cases_on_phone')
+
+    def _get_case_state_lookup(self, list_name):
+        """
+        Gets a dict of case_id -> [raw case state dicts] for one of the
+        case state lists, so that lookups don't have to scan the list.
+
+        The lookup is built lazily and rebuilt whenever the underlying list
+        is replaced or changes size, so it stays consistent with appends
+        and removals made directly on the list.
+        """
+        signature = self._get_list_signature(list_name)
+        if not hasattr(self, '_case_state_lookups'):
+            self._case_state_lookups = {}
+        cached = self._case_state_lookups.get(list_name)
+        if cached is None or not self._signature_matches(cached[0], signature):
+            lookup = defaultdict(list)
+            for case in self._doc[list_name]:
+                lookup[case['case_id']].append(case)
+            cached = (signature, lookup)
+            self._case_state_lookups[list_name] = cached
+        return cached[1]
+
+    def _invalidate_footprint(self):
+        self._footprint_cache = None
+
+    def _invalidate_case_state_lookups(self):
+        self._case_state_lookups = {}
+        self._reference_counts = None
+        self._invalidate_footprint()
+
+    def _get_reference_counts(self):
+        """
+        Gets a dict of case_id -> the number of indices on the case states
+        that reference it. Built lazily like the case state lookups, and
+        then kept up to date by the methods on this class.
+        """
+        references = self._get_current_reference_counts()
+        if references is None:
+            references = defaultdict(int)
+            for name in ('cases_on_phone', 'dependent_cases_on_phone'):
+                for state in self._doc[name]:
+                    for index in state.get('indices') or ():
+                        references[index.get('referenced_id')] += 1
+            self._reference_counts = (self._get_case_lists_signature(), references)
+        return references
+
+    def _get_current_reference_counts(self):
+        # the reference counts, if they've been built and are still current
+        cached = getattr(self, '_reference_counts', None)
+        if cached is not None and self._signature_matches(cached[0], self._get_case_lists_signature()):
+            return cached[1]
+        return None
+
+    def _update_reference_counts(self, references, referenced_ids, change):
+        if references is not None:
+            for case_id in referenced_ids:
+                references[case_id] += change
+            self._reference_counts = (self._get_case_lists_signature(), references)
+
+    def _append_case_state(self, list_name, state):
+        # appends to one of the case state lists, updating the lookups
+        # rather than leaving them to be rebuilt
+        lookup = self._get_case_state_lookup(list_name)
+        references = self._get_current_reference_counts()
+        getattr(self, list_name).append(state)
+        lookup[state.case_id].append(self._doc[list_name][-1])
+        self._case_state_lookups[list_name] = (self._get_list_signature(list_name), lookup)
+        self._update_reference_counts(references, [index.referenced_id for index in state.indices], 1)
+        self._invalidate_footprint()
+
+    def _remove_case_state(self, list_name, state):
+        # removes a state returned by get_case_state or
+        # get_dependent_case_state from its list, updating the lookups
+        lookup = self._get_case_state_lookup(list_name)
+        references = self._get_current_reference_counts()
+        getattr(self, list_name).remove(state)
+        # the list removes the first state equal to this one, which is the
+        # first one in the lookup with its case id
+        raw_states = lookup[state.case_id]
+        raw_states.pop(0)
+        if not raw_states:
+            del lookup[state.case_id]
+        self._case_state_lookups[list_name] = (self._get_list_signature(list_name), lookup)
+        self._update_reference_counts(references, [index.referenced_id for index in state.indices], -1)
+        self._invalidate_footprint()
+
     def phone_has_case(self, case_id):
         """
         Whether the phone currently has a case, according to this sync log
@@ -171,12 +296,12 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
         # (which couchdbkit does not make any effort to cache on repeated calls)
         # deterministically this change shaved off 10 seconds from an ota restore
         # of about 300 cases.
-        filtered_list = [case for case in self._doc['cases_on_phone'] if case['case_id'] == case_id]
+        filtered_list = self._get_case_state_lookup('cases_on_phone').get(case_id)
         if filtered_list:
             self._assert(len(filtered_list) == 1, \
                          "Should be exactly 0 or 1 cases on phone but were %s for %s" % \
                          (len(filtered_list), case_id))
-            return CaseState.wrap(filtered_list[0])
+            return self._wrap_case_state(filtered_list[0])
         return None
 
     def phone_has_dependent_case(self, case_id):
@@ -191,24 +316,55 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
         object is found
         """
         # see comment in get_case_state for reasoning
-        filtered_list = [case for case in self._doc['dependent_cases_on_phone'] if case['case_id'] == case_id]
+        filtered_list = self._get_case_state_lookup('dependent_cases_on_phone').get(case_id)
         if filtered_list:
             self._assert(len(filtered_list) == 1, \
                          "Should be exactly 0 or 1 dependent cases on phone but were %s for %s" % \
                          (len(filtered_list), case_id))
-            return CaseState.wrap(filtered_list[0])
+            return self._wrap_case_state(filtered_list[0])
         return None
 
+    def _wrap_case_state(self, raw_state):
+        state = CaseState.wrap(raw_state)
+        state._sync_log = self
+        return state
+
+    def _case_state_indices_changed(self, old_referenced_ids, new_referenced_ids):
+        # called when the indices of one of the states are updated in place
+        self._invalidate_footprint()
+        references = self._get_current_reference_counts()
+        self._update_reference_counts(references, old_referenced_ids, -1)
+        self._update_reference_counts(references, new_referenced_ids, 1)
+        self._indices_changed(set(old_referenced_ids) | set(new_referenced_ids))
+
     def _get_case_state_from_anywhere(self, case_id):
         return self.get_case_state(case_id) or self.get_dependent_case_state(case_id)
 
     def archive_case(self, case_id):
+        self._start_footprint_change()
+        self._archive_case(case_id)
+        self._finish_footprint_change()
+
+    def _archive_case(self, case_id):
         state = self.get_case_state(case_id)
-        self.cases_on_phone.remove(state)
+        was_dependent = self.phone_has_dependent_case(case_id)
+        self._remove_case_state('cases_on_phone', state)
         # I'm not quite clear on when this can happen, but we've seen it
         # in wild, so safeguard against it.
-        if not self.phone_has_dependent_case(case_id):
-            self.dependent_cases_on_phone.append(state)
+        if not was_dependent:
+            self._append_case_state('dependent_cases_on_phone', state)
+
+        if case_id in self._get_case_state_lookup('cases_on_phone'):
+            # a duplicate state is still owned, so nothing leaves the footprint
+            return
+        dependents = self._get_case_state_lookup('dependent_cases_on_phone')
+        if (was_dependent or self._get_reference_counts().get(case_id) or
+                any(index.referenced_id in dependents for index in state.indices)):
+            # the case, or dependent cases it references, may still be
+            # reachable from the cases on the phone
+            self.footprint_hash = None
+        else:
+            self._toggle_footprint_hash(case_id)
 
     def _phone_owns(self, action):
         # whether the phone thinks it owns an action block.
@@ -218,10 +374,12 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
             return action.updated_known_properties["owner_id"] in self.owner_ids_on_phone
         return True
 
-    def update_phone_lists(self, xform, case_list):
+    def update_phone_lists(self, xform, case_list, save=True):
         # for all the cases update the relevant lists in the sync log
         # so that we can build a historical record of what's associated
-        # with the phone
+        # with the phone. with save=False nothing is written, and saving
+        # (and invalidating cached payloads) is left to the caller
+        self._start_footprint_change()
         for case in case_list:
             actions = case.get_actions_for_form(xform.get_id)
             for action in actions:
@@ -230,8 +388,9 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
                     self._assert(not self.phone_has_case(case._id),
                                  'phone has case being created: %s' % case._id)
                     if self._phone_owns(action):
-                        self.cases_on_phone.append(CaseState(case_id=case.get_id,
-                                                             indices=[]))
+                        self._add_to_footprint_hash(case.get_id)
+                        self._append_case_state('cases_on_phone', CaseState(case_id=case.get_id,
+                                                                            indices=[]))
                 elif action.action_type == const.CASE_ACTION_UPDATE:
                     self._assert(
                         self.phone_has_case(case._id),
@@ -242,7 +401,7 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
                     if not self._phone_owns(action):
                         # only action necessary here is in the case of
                         # reassignment to an owner the phone doesn't own
-                        self.archive_case(case.get_id)
+                        self._archive_case(case.get_id)
                 elif action.action_type == const.CASE_ACTION_INDEX:
                     # in the case of parallel reassignment and index update
                     # the phone might not have the case
@@ -257,8 +416,9 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
                         case_state.update_indices(action.indices)
                 elif action.action_type == const.CASE_ACTION_CLOSE:
                     if self.phone_has_case(case.get_id):
-                        self.archive_case(case.get_id)
-        if case_list:
+                        self._archive_case(case.get_id)
+        self._finish_footprint_change()
+        if case_list and save:
             self.invalidate_cached_payloads()
             try:
                 self.save()
@@ -268,11 +428,23 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
                 ))
                 raise
 
-    def get_footprint_of_cases_on_phone(self):
+    def _get_footprint(self):
         """
-        Gets the phone's flat list of all case ids on the phone,
-        owned or not owned but relevant.
+        The set of case ids in the phone's footprint, computed once and
+        reused until the case states change. Callers must not modify it.
+
+        The methods on this class that change the case states, including
+        update_indices on the states they return, clear it. Lists that are
+        replaced or change size are picked up as in _get_case_state_lookup.
         """
+        signature = self._get_case_lists_signature()
+        cached = getattr(self, '_footprint_cache', None)
+        if cached is None or not self._signature_matches(cached[0], signature):
+            cached = (signature, self._compute_footprint())
+            self._footprint_cache = cached
+        return cached[1]
+
+    def _compute_footprint(self):
         def children(case_state):
             return [self._get_case_state_from_anywhere(index.referenced_id) \
                     for index in case_state.indices]
@@ -288,21 +460,84 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
                 queue.extend(children(case_state))
         return relevant_cases
 
+    def get_footprint_of_cases_on_phone(self):
+        """
+        Gets the phone's flat list of all case ids on the phone,
+        owned or not owned but relevant.
+        """
+        return set(self._get_footprint())
+
     def phone_is_holding_case(self, case_id):
         """
-        Whether the phone is holding (not purging) a case.
+        Whether the phone is holding (not purging) a case. To check many
+        cases use get_footprint_of_cases_on_phone instead.
+        """
+        # the footprint is every case on the phone plus every dependent
+        # case still reachable through an index, which is exactly the
+        # set of cases the phone is holding
+        return case_id in self._get_footprint()
+
+    def _compute_footprint_hash(self):
+        self.footprint_hash = Checksum(self._get_footprint()).hexdigest()
+        self._hashed_lists = self._get_case_lists_signature()
+
+    def _check_footprint_hash(self):
+        # footprint_hash is kept up to date by the methods on this class,
+        # which drop it when it can't be updated cheaply. if the lists were
+        # replaced or changed size some other way since, it's dropped too
+        # and recomputed when next needed
+        signature = getattr(self, '_hashed_lists', None)
+        if signature is not None and not self._signature_matches(signature,
+                                                                 self._get_case_lists_signature()):
+            self.footprint_hash = None
+            self._hashed_lists = None
+
+    def _start_footprint_change(self):
+        """
+        Makes sure footprint_hash matches the case states before they are
+        changed, so that it can be updated from just the case ids that are
+        added to or removed from the footprint.
         """
-        # this is inefficient and could be optimized
-        if self.phone_has_case(case_id):
-            return True
+        self._check_footprint_hash()
+        if self.footprint_hash is None:
+            # logs saved before the hash was stored, or whose hash was
+            # dropped because the footprint couldn't be updated cheaply
+            self._compute_footprint_hash()
+
+    def _finish_footprint_change(self):
+        if not self._doc['cases_on_phone']:
+            self.footprint_hash = EMPTY_HASH
+        if self.footprint_hash is not None:
+            self._hashed_lists = self._get_case_lists_signature()
         else:
-            cs = self.get_dependent_case_state(case_id)
-            if cs and case_id in self.get_footprint_of_cases_on_phone():
-                return True
-            return False
+            self._hashed_lists = None
+
+    def _toggle_footprint_hash(self, case_id):
+        if self.footprint_hash is not None:
+            self.footprint_hash = Checksum.update_hexdigest(self.footprint_hash, [case_id])
+
+    def _add_to_footprint_hash(self, case_id):
+        # called before a new state with no indices is added to cases_on_phone
+        if case_id in self._get_case_state_lookup('dependent_cases_on_phone'):
+            # it may already be in the footprint, and the dependent cases it
+            # references may join it
+            self.footprint_hash = None
+        elif case_id not in self._get_case_state_lookup('cases_on_phone'):
+            self._toggle_footprint_hash(case_id)
+
+    def _indices_changed(self, referenced_ids):
+        # indices to owned cases, or to cases the phone doesn't know about,
+        # can't change the footprint. only dependent cases can become
+        # reachable or unreachable
+        dependents = self._get_case_state_lookup('dependent_cases_on_phone')
+        if any(case_id in dependents for case_id in referenced_ids):
+            self.footprint_hash = None
 
     def get_state_hash(self):
-        return CaseStateHash(Checksum(self.get_footprint_of_cases_on_phone()).hexdigest())
+        self._check_footprint_hash()
+        if self.footprint_hash is None:
+            self._compute_footprint_hash()
+        return CaseStateHash(self.footprint_hash)
 
     def reconcile_cases(self):
         """
@@ -311,6 +546,10 @@ class SyncLog(SafeSaveDocument, UnicodeMixIn):
         """
         self.cases_on_phone = list(set(self.cases_on_phone))
         self.dependent_cases_on_phone = list(set(self.dependent_cases_on_phone))
+        self._invalidate_case_state_lookups()
+        # which of the duplicates is used for the footprint can change
+        self.footprint_hash = None
+        self._hashed_lists = None
 
     def __unicode__(self):
         return "%s synced on %s (%s)" % (self.user_id, self.date.date(), self.get_id)
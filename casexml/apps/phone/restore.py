@@ -1,11 +1,18 @@
 from collections import defaultdict
 import hashlib
+import shutil
+import tempfile
+import time
+import uuid
 from couchdbkit import ResourceConflict
-from casexml.apps.stock.consumption import compute_consumption_or_default
+from casexml.apps.stock.consumption import bulk_compute_consumption_or_default
+from dimagi.utils.chunked import chunked
 from dimagi.utils.decorators.memoized import memoized
 from dimagi.utils.parsing import json_format_datetime
-from casexml.apps.case.exceptions import BadStateException, RestoreException
-from casexml.apps.phone.models import SyncLog, CaseState
+from casexml.apps.case.concurrency import run_concurrently
+from casexml.apps.case.exceptions import BadStateException, RestoreException, \
+    RestoreInProgressException, AsyncRestoreFailedException, AsyncRestoreSupersededException
+from casexml.apps.phone.models import SyncLog
 import logging
 from dimagi.utils.couch.database import get_db, get_safe_write_kwargs
 from casexml.apps.phone import xml
@@ -20,11 +27,18 @@ from couchforms.xml import (
 )
 from casexml.apps.case.xml import check_version, V1
 from casexml.apps.phone.fixtures import generator
-from django.http import HttpResponse, Http404
+from casexml.apps.phone.caching import CaseXMLCache, RestoreCaseCache
+from casexml.apps.phone.caselogic import get_incremental_case_updates
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from casexml.apps.phone.checksum import CaseStateHash
 from no_exceptions.exceptions import HttpException
 
 
+def _no_forced_consumption(case):
+    return False
+
+
 class StockSettings(object):
 
     def __init__(self, section_to_consumption_types=None, consumption_config=None,
@@ -37,15 +51,129 @@ class StockSettings(object):
         self.section_to_consumption_types = section_to_consumption_types or {}
         self.consumption_config = consumption_config
         self.default_product_list = default_product_list or []
-        self.force_consumption_case_filter = force_consumption_case_filter or (lambda case: False)
+        # module level so that the settings can be pickled for async restores
+        self.force_consumption_case_filter = force_consumption_case_filter or _no_forced_consumption
+
+
+# the prefix ElementTree gives the stock namespace, which is declared once
+# on the root rather than on every ledger block
+STOCK_NAMESPACE_PREFIX = 'ns0'
+
+
+def _get_ledger_xml(balance):
+    return xml.tostring(balance).replace(
+        ' xmlns:%s="%s"' % (STOCK_NAMESPACE_PREFIX, COMMTRACK_REPORT_XMLNS), '', 1)
+
+
+class RestoreResponse(object):
+    """
+    Accumulates the blocks of an OTA restore one element at a time.
+
+    Each element is serialized and written to a temporary file as soon as
+    it is added, so memory use is bounded by the largest single element
+    rather than by the size of the restore. The root OpenRosaResponse tag
+    is only rendered when the payload is composed, at which point the
+    number of items is known.
+    """
+
+    def __init__(self, username, items=False):
+        self.username = username
+        self.items = items
+        self.num_items = 0
+        # prefix: uri of namespaces to declare on the root
+        self.namespaces = {}
+        self.body = tempfile.TemporaryFile()
+
+    def append(self, element):
+        self.body.write(xml.tostring(element))
+        self.num_items += 1
+
+    def extend(self, elements):
+        for element in elements:
+            self.append(element)
+
+    def append_serialized(self, element_xml):
+        """
+        Like append, but for an element that has already been serialized
+        """
+        self.body.write(element_xml)
+        self.num_items += 1
+
+    def append_serialized_file(self, blocks, num_items):
+        """
+        Appends num_items serialized elements from a file, and closes it
+        """
+        try:
+            shutil.copyfileobj(blocks, self.body)
+        finally:
+            blocks.close()
+        self.num_items += num_items
+
+    def declare_namespace(self, prefix, uri):
+        """
+        Declares a namespace prefix used by the blocks on the root element
+        """
+        self.namespaces[prefix] = uri
+
+    def _get_root_tags(self):
+        # render the (otherwise empty) response element and split it around
+        # its closing tag so the body can be written in between
+        response = get_response_element(
+            "Successfully restored account %s!" % self.username,
+            ResponseNature.OTA_RESTORE_SUCCESS)
+        if self.items:
+            response.attrib['items'] = '%d' % (len(response.getchildren()) + self.num_items)
+        root = xml.tostring(response)
+        if self.namespaces:
+            # ElementTree writes namespace declarations before the attributes
+            tag_end = root.index(response.tag) + len(response.tag)
+            root = root[:tag_end] + ''.join(
+                ' xmlns:%s="%s"' % (prefix, self.namespaces[prefix])
+                for prefix in sorted(self.namespaces)
+            ) + root[tag_end:]
+        close_index = root.rindex('</')
+        return root[:close_index], root[close_index:]
+
+    def get_file(self):
+        """
+        Returns a file-like object containing the full payload, positioned
+        at the start.
+        """
+        start, end = self._get_root_tags()
+        payload = tempfile.TemporaryFile()
+        payload.write(start)
+        self.body.seek(0)
+        shutil.copyfileobj(self.body, payload)
+        payload.write(end)
+        self.body.close()
+        payload.seek(0)
+        return payload
+
+    def as_string(self):
+        payload = self.get_file()
+        try:
+            return payload.read()
+        finally:
+            payload.close()
 
 
 class RestoreConfig(object):
     """
     A collection of attributes associated with an OTA restore
     """
+    # how long a restore can hold the in progress lock before it is assumed dead
+    in_progress_timeout = 10 * 60
+    # how long a duplicate request waits for the in progress restore
+    in_progress_wait = 30
+    in_progress_poll_interval = 1
+    # what a duplicate request that gave up waiting is told
+    retry_after = 60
+
     def __init__(self, user, restore_id="", version=V1, state_hash="",
-                 caching_enabled=False, items=False, stock_settings=None):
+                 caching_enabled=False, items=False, stock_settings=None,
+                 stream=False, case_xml_caching_enabled=False, incremental=False,
+                 restore_case_caching_enabled=False, coalesce_restores=False,
+                 async_restore=False):
         self.user = user
         self.restore_id = restore_id
         self.version = version
@@ -54,6 +182,15 @@ class RestoreConfig(object):
         self.cache = get_redis_default_cache()
         self.items = items
         self.stock_settings = stock_settings or StockSettings()
+        self.stream = stream
+        self.case_xml_caching_enabled = case_xml_caching_enabled
+        self.incremental = incremental
+        self.restore_case_caching_enabled = restore_case_caching_enabled
+        self.coalesce_restores = coalesce_restores
+        self.async_restore = async_restore
+        # set to something with a set_progress(done, total) method to be
+        # told how many of the case blocks have been written
+        self.progress = None
 
     @property
     @memoized
@@ -92,111 +229,221 @@ class RestoreConfig(object):
         def transaction_to_xml(trans):
             return entry_xml(trans.product_id, trans.stock_on_hand)
 
-        def consumption_entry(case_id, product_id, section_id):
-            consumption_value = compute_consumption_or_default(
-                case_id,
-                product_id,
-                datetime.utcnow(),
-                section_id,
-                self.stock_settings.consumption_config
-            )
-            if consumption_value is not None:
-                return entry_xml(product_id, consumption_value)
-
-        def _unique_products(stock_transaction_queryset):
-            return sorted(stock_transaction_queryset.values_list('product_id', flat=True).distinct())
-
-        for commtrack_case in cases:
-            relevant_sections = sorted(StockTransaction.objects.filter(
-                case_id=commtrack_case._id).values_list('section_id', flat=True).distinct())
-
-            section_product_map = defaultdict(lambda: [])
-            section_timestamp_map = defaultdict(lambda: json_format_datetime(datetime.utcnow()))
-            for section_id in relevant_sections:
-                relevant_reports = StockTransaction.objects.filter(case_id=commtrack_case._id, section_id=section_id)
-                product_ids = _unique_products(relevant_reports)
-                transactions = [StockTransaction.latest(commtrack_case._id, section_id, p) for p in product_ids]
-                as_of = json_format_datetime(max(txn.report.date for txn in transactions))
-                section_product_map[section_id] = product_ids
-                section_timestamp_map[section_id] = as_of
-                yield E.balance(*(transaction_to_xml(e) for e in transactions),
-                                **{'entity-id': commtrack_case._id, 'date': as_of, 'section-id': section_id})
-
-
+        def _consumption_sections(commtrack_case, latest_by_section):
+            # (section id, consumption section id, product ids) for each
+            # consumption balance that should be sent for the case
             for section_id, consumption_section_id in self.stock_settings.section_to_consumption_types.items():
 
-                if (section_id in relevant_sections or
+                if (section_id in latest_by_section or
                     self.stock_settings.force_consumption_case_filter(commtrack_case)):
 
                     consumption_product_ids = self.stock_settings.default_product_list \
                         if self.stock_settings.default_product_list \
-                        else section_product_map[section_id]
+                        else sorted(latest_by_section.get(section_id, {}))
+                    yield section_id, consumption_section_id, consumption_product_ids
+
+        # look up the latest transactions and consumption a chunk of cases
+        # at a time rather than issuing queries per case, section and product
+        for chunk in chunked(cases, 100):
+            latest_transactions = StockTransaction.latest_for_cases([c._id for c in chunk])
+            consumption_sections = dict(
+                (c._id, list(_consumption_sections(c, latest_transactions.get(c._id, {}))))
+                for c in chunk
+            )
+            consumption = bulk_compute_consumption_or_default(
+                [(case_id, product_id, section_id)
+                 for case_id, sections in consumption_sections.items()
+                 for section_id, _, product_ids in sections
+                 for product_id in product_ids],
+                datetime.utcnow(),
+                self.stock_settings.consumption_config
+            )
 
+            for commtrack_case in chunk:
+                latest_by_section = latest_transactions.get(commtrack_case._id, {})
+
+                section_timestamp_map = defaultdict(lambda: json_format_datetime(datetime.utcnow()))
+                for section_id in sorted(latest_by_section):
+                    latest_by_product = latest_by_section[section_id]
+                    transactions = [latest_by_product[p] for p in sorted(latest_by_product)]
+                    as_of = json_format_datetime(max(txn.report.date for txn in transactions))
+                    section_timestamp_map[section_id] = as_of
+                    yield E.balance(*(transaction_to_xml(e) for e in transactions),
+                                    **{'entity-id': commtrack_case._id, 'date': as_of, 'section-id': section_id})
+
+                for section_id, consumption_section_id, product_ids in consumption_sections[commtrack_case._id]:
+                    consumption_values = [(p, consumption[(commtrack_case._id, p, section_id)])
+                                          for p in product_ids]
                     yield E.balance(
-                        *filter(lambda e: e is not None,
-                                [consumption_entry(commtrack_case._id, p, section_id)
-                                 for p in consumption_product_ids]),
+                        *[entry_xml(p, value) for p, value in consumption_values if value is not None],
                         **{'entity-id': commtrack_case._id, 'date': section_timestamp_map[section_id],
                            'section-id': consumption_section_id}
                     )
 
-    def get_payload(self):
+    def _generate_restore_response(self):
+        """
+        Computes the restore for this config, saves the new sync log and
+        returns a RestoreResponse with all blocks written to it.
+        """
         user = self.user
         last_sync = self.sync_log
 
-        self.validate()
-
-        cached_payload = self.get_cached_payload()
-        if cached_payload:
-            return cached_payload
-
-        sync_operation = user.get_case_updates(last_sync)
-        case_xml_elements = [xml.get_case_element(op.case, op.required_updates, self.version)
-                             for op in sync_operation.actual_cases_to_sync]
-        commtrack_elements = self.get_stock_payload(sync_operation)
-
+        # get this before looking at any cases so that nothing that changes
+        # while the restore is being generated is missed by the next
+        # incremental sync
         last_seq = str(get_db().info()["update_seq"])
 
+        def _get_sync_operation():
+            sync_operation = None
+            if self.incremental:
+                sync_operation = get_incremental_case_updates(user, last_sync)
+            if sync_operation is None:
+                sync_operation = user.get_case_updates(last_sync)
+            return sync_operation
+
+        def _get_fixtures():
+            return generator.get_serialized_fixtures_with_timings(user, self.version, last_sync, self.cache)
+
+        restore_case_cache = self._get_restore_case_cache()
+        cached_cases = restore_case_cache.get() if restore_case_cache else None
+        if cached_cases is not None:
+            fixtures, fixture_cache_keys, fixture_timings = _get_fixtures()
+            cases_on_phone = cached_cases['cases_on_phone']
+            dependent_cases_on_phone = cached_cases['dependent_cases_on_phone']
+        else:
+            # fixtures don't depend on the cases being synced
+            sync_operation, (fixtures, fixture_cache_keys, fixture_timings) = run_concurrently(
+                _get_sync_operation, _get_fixtures)
+            cases_on_phone = sync_operation.get_owned_case_states()
+            dependent_cases_on_phone = sync_operation.get_extended_case_states()
+
         # create a sync log for this
         previous_log_id = last_sync.get_id if last_sync else None
 
         synclog = SyncLog(user_id=user.user_id, last_seq=last_seq,
                           owner_ids_on_phone=user.get_owner_ids(),
                           date=datetime.utcnow(), previous_log_id=previous_log_id,
-                          cases_on_phone=[CaseState.from_case(c) for c in \
-                                          sync_operation.actual_owned_cases],
-                          dependent_cases_on_phone=[CaseState.from_case(c) for c in \
-                                                    sync_operation.actual_extended_cases])
+                          cases_on_phone=cases_on_phone,
+                          dependent_cases_on_phone=dependent_cases_on_phone,
+                          fixture_cache_keys=fixture_cache_keys)
         synclog.save(**get_safe_write_kwargs())
 
         # start with standard response
-        response = get_response_element(
-            "Successfully restored account %s!" % user.username,
-            ResponseNature.OTA_RESTORE_SUCCESS)
-
+        response = RestoreResponse(user.username, items=self.items)
         # add sync token info
         response.append(xml.get_sync_element(synclog.get_id))
         # registration block
         response.append(xml.get_registration_element(user))
         # fixture block
-        for fixture in generator.get_fixtures(user, self.version, last_sync):
-            response.append(fixture)
+        if fixture_timings:
+            logging.info('fixtures for %s generated in %s' % (
+                user.user_id, ', '.join('%s: %.2fs' % timing for timing in fixture_timings)
+            ))
+        for fixture in fixtures:
+            response.append_serialized(fixture)
+
+        if cached_cases is not None:
+            num_cases = cached_cases['counts']['case_xml']
+            self._set_progress(0, num_cases)
+            response.append_serialized_file(cached_cases['case_xml'], num_cases)
+            self._set_progress(num_cases, num_cases)
+            if cached_cases['counts']['ledger_xml']:
+                response.append_serialized_file(cached_cases['ledger_xml'],
+                                                cached_cases['counts']['ledger_xml'])
+                response.declare_namespace(STOCK_NAMESPACE_PREFIX, COMMTRACK_REPORT_XMLNS)
+            else:
+                cached_cases['ledger_xml'].close()
+            return response
+
+        num_cases = len(sync_operation.actual_cases_to_sync)
+        case_xml = self._iter_case_xml(sync_operation)
+        ledger_xml = (_get_ledger_xml(balance) for balance in self.get_stock_payload(sync_operation))
+        if restore_case_cache:
+            ledger_watermark = restore_case_cache.get_ledger_watermark()
+            case_xml = restore_case_cache.cache_blocks('case_xml', case_xml)
+            ledger_xml = restore_case_cache.cache_blocks('ledger_xml', ledger_xml)
+
         # case blocks
-        for case_elem in case_xml_elements:
-            response.append(case_elem)
-        for ct_elem in commtrack_elements:
-            response.append(ct_elem)
+        self._set_progress(0, num_cases)
+        for i, block in enumerate(case_xml, 1):
+            response.append_serialized(block)
+            if i % 100 == 0:
+                self._set_progress(i, num_cases)
+        self._set_progress(num_cases, num_cases)
+        # ledger blocks
+        for block in ledger_xml:
+            response.append_serialized(block)
+            response.declare_namespace(STOCK_NAMESPACE_PREFIX, COMMTRACK_REPORT_XMLNS)
+
+        if restore_case_cache:
+            restore_case_cache.set(last_seq, ledger_watermark, cases_on_phone, dependent_cases_on_phone)
+        return response
+
+    def _iter_case_xml(self, sync_operation):
+        if self.case_xml_caching_enabled:
+            case_xml_cache = CaseXMLCache(self.cache, self.version)
+            return case_xml_cache.iter_case_xml(sync_operation.actual_cases_to_sync)
+        return (xml.get_case_xml(op.case, op.required_updates, self.version)
+                for op in sync_operation.actual_cases_to_sync)
+
+    def _set_progress(self, done, total):
+        if self.progress:
+            self.progress.set_progress(done, total)
+
+    def _get_restore_case_cache(self):
+        # the case portion of initial restores can be shared between users
+        if self.restore_case_caching_enabled and not self.sync_log:
+            return RestoreCaseCache(self.cache, self.user.domain, self.user.get_owner_ids(), self.version)
 
-        if self.items:
-            response.attrib['items'] = '%d' % len(response.getchildren())
+    def get_payload(self):
+        self.validate()
 
-        resp = xml.tostring(response)
+        cached_payload = self.get_cached_payload()
+        if cached_payload:
+            return cached_payload
+
+        if self.coalesce_restores:
+            return self._get_coalesced_payload()
+        return self._generate_payload()
+
+    def _generate_payload(self):
+        resp = self._generate_restore_response().as_string()
         self.set_cached_payload_if_enabled(resp)
         return resp
 
+    def get_streaming_response(self):
+        """
+        Like get_payload, but streams the payload back from a temporary
+        file instead of building it as one string in memory.
+        """
+        self.validate()
+
+        cached_payload = self.get_cached_payload()
+        if cached_payload:
+            return HttpResponse(cached_payload, mimetype="text/xml")
+
+        if self.coalesce_restores:
+            # duplicate requests share the payload through the cache, so it
+            # has to be held in memory anyway
+            return HttpResponse(self._get_coalesced_payload(), mimetype="text/xml")
+
+        payload = self._generate_restore_response().get_file()
+        if self.caching_enabled:
+            # the cache backends only accept strings, so caching a streamed
+            # restore means reading it back into memory once
+            self.set_cached_payload_if_enabled(payload.read())
+            payload.seek(0)
+        return StreamingHttpResponse(FileWrapper(payload), mimetype="text/xml")
+
     def get_response(self):
         try:
+            if self.async_restore:
+                return AsyncRestore(self).get_response()
+            if self.stream:
+                return self.get_streaming_response()
             return HttpResponse(self.get_payload(), mimetype="text/xml")
+        except RestoreInProgressException, e:
+            return get_retry_response(e.message, e.retry_after)
         except RestoreException, e:
             logging.exception("%s error during restore submitted by %s: %s" %
                               (type(e).__name__, self.user.username, str(e)))
@@ -213,6 +460,60 @@ class RestoreConfig(object):
             version=self.version,
         )).hexdigest()
 
+    def _in_progress_key(self):
+        return hashlib.md5('ota-restore-in-progress-{user}-{restore_id}-{version}'.format(
+            user=self.user.user_id,
+            restore_id=self.restore_id,
+            version=self.version,
+        )).hexdigest()
+
+    def _in_progress_result_key(self, token):
+        return hashlib.md5('ota-restore-in-progress-result-{token}'.format(token=token)).hexdigest()
+
+    def _get_coalesced_payload(self):
+        """
+        Generates the payload unless an identical restore (same user, sync
+        token and version) is already being generated, in which case this
+        waits for and returns that restore's payload instead.
+
+        Raises RestoreInProgressException if the other restore doesn't finish
+        within in_progress_wait seconds.
+        """
+        lock_key = self._in_progress_key()
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.in_progress_wait
+        while not self.cache.add(lock_key, token, self.in_progress_timeout):
+            payload = self._wait_for_in_progress_payload(lock_key, deadline)
+            if payload is not None:
+                return payload
+            # the other restore went away without a result, so try to take
+            # over. if another waiter got there first, wait for that one
+            logging.warning("restore in progress for %s finished without a payload" %
+                            self.user.username)
+
+        try:
+            payload = self._generate_payload()
+            # shared with any requests that are waiting on this one
+            self.cache.set(self._in_progress_result_key(token), payload, self.in_progress_wait)
+            return payload
+        finally:
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+
+    def _wait_for_in_progress_payload(self, lock_key, deadline):
+        token = self.cache.get(lock_key)
+        while token is not None:
+            payload = self.cache.get(self._in_progress_result_key(token))
+            if payload is not None:
+                return payload
+            if time.time() >= deadline:
+                raise RestoreInProgressException(retry_after=self.retry_after)
+            time.sleep(self.in_progress_poll_interval)
+            if self.cache.get(lock_key) != token:
+                # finished (or died) since the last check
+                return self.cache.get(self._in_progress_result_key(token))
+        return None
+
     def get_cached_payload(self):
         if self.caching_enabled:
             if self.sync_log:
@@ -234,6 +535,175 @@ class RestoreConfig(object):
                 self.cache.set(self._initial_cache_key(), resp, 60*60)
 
 
+def get_retry_response(message, retry_after):
+    """
+    A 202 (accepted) response telling the phone to try again later
+    """
+    response = HttpResponse(
+        get_simple_response_xml(message, ResponseNature.OTA_RESTORE_ERROR),
+        mimetype="text/xml",
+        status=202,
+    )
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class AsyncRestore(object):
+    """
+    Generates a restore in a celery task instead of in the request.
+
+    The first request starts the task and is told to retry. Later requests
+    get the progress of the task until it finishes, at which point the next
+    request is served the payload the task left in the cache. Progress is
+    reported as a dict with the task's token ('task'), its status, the
+    number of case blocks written ('done') out of the total ('total'),
+    which is None until the total is known, and when it was last updated
+    ('updated'). If it hasn't been updated for stale_after seconds the task
+    is assumed to have died and a new one is started with a new token. A
+    task only updates the progress and publishes its payload while the
+    progress still has its token, so a task that was replaced stops as
+    soon as it notices. If the task fails the next request gets an error
+    instead of being told to retry.
+
+    Everything passed to the RestoreConfig has to be picklable, including
+    any force_consumption_case_filter in the stock settings.
+    """
+    timeout = 60 * 60
+    retry_after = 30
+    stale_after = 10 * 60
+
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, config, task=None):
+        self.config = config
+        self.cache = config.cache
+        # the token of the task generating the restore, if this is it
+        self.task = task
+
+    def _get_key(self, name):
+        return hashlib.md5('ota-restore-async-{name}-{user}-{restore_id}-{version}'.format(
+            name=name,
+            user=self.config.user.user_id,
+            restore_id=self.config.restore_id,
+            version=self.config.version,
+        )).hexdigest()
+
+    def _get_payload_key(self, task):
+        return self._get_key('payload-%s' % task)
+
+    def get_progress(self):
+        """
+        The progress of the restore task, or None if there isn't one.
+        """
+        return self.cache.get(self._get_key('progress'))
+
+    def set_progress(self, done, total, status=RUNNING):
+        """
+        Updates the progress of this task, raising
+        AsyncRestoreSupersededException if it has been replaced.
+        """
+        current = self.get_progress()
+        if current is None or current['task'] != self.task:
+            raise AsyncRestoreSupersededException()
+        self.cache.set(self._get_key('progress'),
+                       self._get_progress(self.task, done, total, status), self.timeout)
+
+    @classmethod
+    def _get_progress(cls, task, done, total, status=RUNNING):
+        return {'task': task, 'status': status, 'done': done, 'total': total,
+                'updated': time.time()}
+
+    def _is_stale(self, progress):
+        return time.time() - progress['updated'] > self.stale_after
+
+    def get_response(self):
+        config = self.config
+        config.validate()
+        payload = config.get_cached_payload()
+        if payload:
+            return HttpResponse(payload, mimetype="text/xml")
+
+        progress = self.get_progress()
+        if progress is not None and progress['status'] != self.RUNNING:
+            # the next restore for the same token should be generated again
+            self.cache.delete(self._get_key('progress'))
+            if progress['status'] == self.FAILED:
+                raise AsyncRestoreFailedException()
+            payload = self._pop_payload(progress['task'])
+            if payload is not None:
+                return HttpResponse(payload, mimetype="text/xml")
+            progress = None
+
+        if progress is None:
+            progress = self._get_progress(uuid.uuid4().hex, 0, None)
+            if self.cache.add(self._get_key('progress'), progress, self.timeout):
+                self._start(progress['task'])
+        elif self._is_stale(progress):
+            # only one request restarts the task for a given stale progress
+            restart_key = self._get_key('restart-%s' % progress['task'])
+            if self.cache.add(restart_key, True, self.stale_after):
+                logging.warning('restarting async restore for %s that stopped making progress'
+                                % self.config.user.user_id)
+                progress = self._get_progress(uuid.uuid4().hex, 0, None)
+                self.cache.set(self._get_key('progress'), progress, self.timeout)
+                self._start(progress['task'])
+
+        if progress['total'] is None:
+            message = "Your restore is being prepared."
+        else:
+            message = "Your restore is being prepared (%(done)s of %(total)s cases)." % progress
+        return get_retry_response(message, self.retry_after)
+
+    def generate(self):
+        """
+        Generates the payload and leaves it in the cache for the next request.
+        Called from the celery task.
+        """
+        config = self.config
+        config.progress = self
+        try:
+            self.set_progress(0, None)
+            payload = config._generate_payload()
+            self.cache.set(self._get_payload_key(self.task), payload, self.timeout)
+            try:
+                self.set_progress(None, None, self.DONE)
+            except AsyncRestoreSupersededException:
+                self.cache.delete(self._get_payload_key(self.task))
+                raise
+        except AsyncRestoreSupersededException:
+            logging.warning('async restore task %s for %s was replaced by a newer one'
+                            % (self.task, self.config.user.user_id))
+        except Exception:
+            try:
+                self.set_progress(None, None, self.FAILED)
+            except AsyncRestoreSupersededException:
+                pass
+            raise
+
+    def _pop_payload(self, task):
+        payload = self.cache.get(self._get_payload_key(task))
+        if payload is not None:
+            self.cache.delete(self._get_payload_key(task))
+        return payload
+
+    def _start(self, task):
+        from casexml.apps.phone.tasks import generate_restore_async
+        config = self.config
+        generate_restore_async.delay(
+            config.user, config.restore_id, config.version,
+            task=task,
+            state_hash=config.state_hash,
+            caching_enabled=config.caching_enabled,
+            items=config.items,
+            stock_settings=config.stock_settings,
+            case_xml_caching_enabled=config.case_xml_caching_enabled,
+            incremental=config.incremental,
+            restore_case_caching_enabled=config.restore_case_caching_enabled,
+        )
+
+
 def generate_restore_payload(user, restore_id="", version=V1, state_hash="",
                              items=False):
     """
@@ -254,6 +724,7 @@ def generate_restore_payload(user, restore_id="", version=V1, state_hash="",
 
 
 def generate_restore_response(user, restore_id="", version=V1, state_hash="",
-                              items=False):
-    config = RestoreConfig(user, restore_id, version, state_hash, items=items)
+                              items=False, stream=False, async_restore=False):
+    config = RestoreConfig(user, restore_id, version, state_hash, items=items,
+                           stream=stream, async_restore=async_restore)
     return config.get_response()
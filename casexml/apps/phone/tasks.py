@@ -0,0 +1,11 @@
+from celery.task import task
+from casexml.apps.phone.restore import RestoreConfig, AsyncRestore
+
+
+@task
+def generate_restore_async(user, restore_id, version, task=None, **kwargs):
+    """
+    Generates a restore for AsyncRestore, leaving the payload in the cache
+    """
+    config = RestoreConfig(user, restore_id, version, **kwargs)
+    AsyncRestore(config, task).generate()
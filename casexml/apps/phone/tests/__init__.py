@@ -1,5 +1,7 @@
 import logging
 try:
+    from .test_caching import *
+    from .test_fixtures import *
     from .test_ota_restore import *
     from .test_state_hash import *
     from .test_sync_logs import *
@@ -0,0 +1,36 @@
+"""
+Micro-benchmark for computing case state hashes over large footprints.
+
+Not part of the test suite. Run from the repository root with:
+
+    python casexml/apps/phone/tests/checksum_benchmark.py [number of ids]
+"""
+import binascii
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..'))
+
+from casexml.apps.phone.checksum import Checksum
+
+
+def bytewise_hexdigest(ids):
+    # the original implementation: XOR the digests one byte at a time
+    return binascii.hexlify(str(reduce(Checksum.xor, map(Checksum.hash, ids))))
+
+
+def main(num_ids=100000, repeat=3):
+    ids = [uuid.uuid4().hex for i in range(num_ids)]
+    assert Checksum(ids).hexdigest() == bytewise_hexdigest(ids)
+
+    bytewise = min(timeit.repeat(lambda: bytewise_hexdigest(ids), number=1, repeat=repeat))
+    integer = min(timeit.repeat(lambda: Checksum(ids).hexdigest(), number=1, repeat=repeat))
+    print "%d ids" % num_ids
+    print "bytewise: %.3fs" % bytewise
+    print "integer:  %.3fs (%.1fx)" % (integer, bytewise / integer)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,306 @@
+from datetime import datetime
+import pickle
+import uuid
+from mock import patch
+from django.core.cache import get_cache
+from django.test import TestCase
+from dimagi.utils.couch.database import get_db
+from casexml.apps.case.mock import CaseBlock
+from casexml.apps.case.models import CommCareCase
+from casexml.apps.case.tests.util import delete_all_cases, delete_all_xforms
+from casexml.apps.case.util import post_case_blocks
+from casexml.apps.case.xml import V1, V2
+from casexml.apps.phone import xml
+from casexml.apps.phone.caching import CaseXMLCache, RestoreCaseCache
+from casexml.apps.phone.caselogic import CaseSyncUpdate
+from casexml.apps.phone.models import CaseState
+from casexml.apps.phone.restore import RestoreConfig, AsyncRestore, StockSettings
+from casexml.apps.phone.tests.dummy import dummy_user
+from casexml.apps.stock.consumption import ConsumptionConfiguration
+from casexml.apps.stock.tests.base import _stock_report
+
+
+class CaseXMLCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+        self.case = CommCareCase(
+            _id=uuid.uuid4().hex,
+            type='cached_type',
+            name='cached name',
+            user_id='cached-user',
+            modified_on=datetime(2014, 3, 1, 12, 0),
+        )
+        self.case.some_property = 'original'
+        self.updates = [CaseSyncUpdate(self.case, None)]
+
+    def testMatchesGeneratedXML(self):
+        for version in (V1, V2):
+            [case_xml] = CaseXMLCache(self.cache, version).iter_case_xml(self.updates)
+            self.assertEqual(
+                xml.get_case_xml(self.case, self.updates[0].required_updates, version),
+                case_xml,
+            )
+
+    def testCacheHitSkipsGeneration(self):
+        xml_cache = CaseXMLCache(self.cache, V2)
+        [original] = xml_cache.iter_case_xml(self.updates)
+        self.assertTrue('original' in original)
+
+        # same version token, so the stale block comes back from the cache
+        self.case.some_property = 'changed'
+        [cached] = xml_cache.iter_case_xml(self.updates)
+        self.assertEqual(original, cached)
+
+        # a new modification date means a new version token
+        self.case.modified_on = datetime(2014, 3, 2, 12, 0)
+        [regenerated] = xml_cache.iter_case_xml(self.updates)
+        self.assertTrue('changed' in regenerated)
+
+    def testKeyIncludesVersionAndUpdates(self):
+        v1_key = CaseXMLCache(self.cache, V1).get_key(self.case, ['create', 'update'])
+        v2_key = CaseXMLCache(self.cache, V2).get_key(self.case, ['create', 'update'])
+        self.assertNotEqual(v1_key, v2_key)
+        self.assertEqual(v2_key, CaseXMLCache(self.cache, V2).get_key(self.case, ['update', 'create']))
+        self.assertNotEqual(v2_key, CaseXMLCache(self.cache, V2).get_key(self.case, ['update']))
+
+
+class RestoreCaseCacheTest(TestCase):
+
+    def setUp(self):
+        delete_all_cases()
+        delete_all_xforms()
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+
+    def _create_case(self, case_id, owner_id):
+        post_case_blocks([CaseBlock(create=True, case_id=case_id, user_id=owner_id,
+                                    owner_id=owner_id, version=V2).as_xml()])
+        return CommCareCase.get(case_id)
+
+    def _set_entry(self, restore_cache, case):
+        last_seq = str(get_db().info()["update_seq"])
+        ledger_watermark = restore_cache.get_ledger_watermark()
+        list(restore_cache.cache_blocks('case_xml', ['<case/>']))
+        list(restore_cache.cache_blocks('ledger_xml', []))
+        restore_cache.set(last_seq, ledger_watermark, [CaseState.from_case(case)], [])
+
+    def testSharedBetweenOwners(self):
+        case = self._create_case('shared-restore-case', 'group-owner')
+        self._set_entry(RestoreCaseCache(self.cache, None, ['group-owner', 'user-a'], V2), case)
+
+        # same owners in a different order
+        entry = RestoreCaseCache(self.cache, None, ['user-a', 'group-owner'], V2).get()
+        self.assertEqual(['shared-restore-case'], [state.case_id for state in entry['cases_on_phone']])
+        self.assertEqual({'case_xml': 1, 'ledger_xml': 0}, entry['counts'])
+        self.assertEqual('<case/>', entry['case_xml'].read())
+
+        self.assertEqual(None, RestoreCaseCache(self.cache, None, ['user-b', 'group-owner'], V2).get())
+        self.assertEqual(None, RestoreCaseCache(self.cache, None, ['user-a', 'group-owner'], V1).get())
+
+    def testStaleAfterChanges(self):
+        owner_ids = ['stale-owner']
+        case = self._create_case('stale-restore-case', 'stale-owner')
+        restore_cache = RestoreCaseCache(self.cache, None, owner_ids, V2)
+        self._set_entry(restore_cache, case)
+        self.assertNotEqual(None, restore_cache.get())
+
+        # an unrelated case doesn't invalidate the entry
+        self._create_case('unrelated-restore-case', 'someone-else')
+        self.assertNotEqual(None, restore_cache.get())
+
+        # a new case for the owner does
+        self._create_case('new-restore-case', 'stale-owner')
+        self.assertEqual(None, restore_cache.get())
+
+        # as does an update to a cached case
+        self._set_entry(restore_cache, CommCareCase.get('stale-restore-case'))
+        self.assertNotEqual(None, restore_cache.get())
+        post_case_blocks([CaseBlock(create=False, case_id='stale-restore-case',
+                                    version=V2, update={'edited': 'yes'}).as_xml()])
+        self.assertEqual(None, restore_cache.get())
+
+    def testStaleAfterStockTransactions(self):
+        case = self._create_case('stock-restore-case', 'stock-owner')
+        restore_cache = RestoreCaseCache(self.cache, None, ['stock-owner'], V2)
+        self._set_entry(restore_cache, case)
+
+        # stock for a case that isn't in the entry doesn't invalidate it
+        _stock_report('unrelated-stock-case', 'stock-product', 10, 1)
+        self.assertNotEqual(None, restore_cache.get())
+
+        _stock_report(case._id, 'stock-product', 10, 0)
+        self.assertEqual(None, restore_cache.get())
+
+    def testStoredInChunks(self):
+        case = self._create_case('chunked-restore-case', 'chunked-owner')
+        restore_cache = RestoreCaseCache(self.cache, None, ['chunked-owner'], V2)
+        restore_cache.chunksize = 2
+        last_seq = str(get_db().info()["update_seq"])
+        ledger_watermark = restore_cache.get_ledger_watermark()
+        blocks = ['<case id="%s"/>' % i for i in range(5)]
+        # the blocks go through as they're cached
+        self.assertEqual(blocks, list(restore_cache.cache_blocks('case_xml', iter(blocks))))
+        list(restore_cache.cache_blocks('ledger_xml', ['<balance/>']))
+        restore_cache.set(last_seq, ledger_watermark, [CaseState.from_case(case)], [])
+
+        entry = restore_cache.get()
+        self.assertEqual({'case_xml': 5, 'ledger_xml': 1}, entry['counts'])
+        self.assertEqual(''.join(blocks), entry['case_xml'].read())
+        self.assertEqual('<balance/>', entry['ledger_xml'].read())
+
+        # if part of the entry is evicted none of it is used
+        self.cache.delete(restore_cache._get_chunk_key(restore_cache._token, 'case_xml', 1))
+        self.assertEqual(None, restore_cache.get())
+
+    def testNotCachedWhenTooBig(self):
+        case = self._create_case('big-restore-case', 'big-owner')
+        restore_cache = RestoreCaseCache(self.cache, None, ['big-owner'], V2)
+        restore_cache.chunksize = 1
+        restore_cache.max_size = 10
+        last_seq = str(get_db().info()["update_seq"])
+        ledger_watermark = restore_cache.get_ledger_watermark()
+        blocks = ['<case id="big"/>', '<case/>']
+        self.assertEqual(blocks, list(restore_cache.cache_blocks('case_xml', blocks)))
+        list(restore_cache.cache_blocks('ledger_xml', []))
+        restore_cache.set(last_seq, ledger_watermark, [CaseState.from_case(case)], [])
+        self.assertEqual(None, restore_cache.get())
+
+
+class RestoreCoalescingTest(TestCase):
+
+    def setUp(self):
+        self.config = RestoreConfig(dummy_user(), version=V2, coalesce_restores=True)
+        self.config.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.config.cache.clear()
+        self.config.in_progress_wait = 0
+        self.config.in_progress_poll_interval = 0
+
+    def testDuplicateReusesInProgressPayload(self):
+        self.config.cache.set(self.config._in_progress_key(), 'other-restore')
+        self.config.cache.set(self.config._in_progress_result_key('other-restore'), '<in-progress/>')
+        self.assertEqual('<in-progress/>', self.config.get_payload())
+
+    def testDuplicateIsToldToRetry(self):
+        self.config.cache.set(self.config._in_progress_key(), 'other-restore')
+        response = self.config.get_response()
+        self.assertEqual(202, response.status_code)
+        self.assertEqual(str(self.config.retry_after), response['Retry-After'])
+
+    def testWaitsForTakeoverAfterLostPayload(self):
+        self.config.in_progress_wait = 5
+        self.config.cache.set(self.config._in_progress_key(), 'dead-restore')
+
+        def _sleep(seconds):
+            # the first restore goes away without a payload and another
+            # waiter takes over before this one retries
+            self.config.cache.set(self.config._in_progress_key(), 'other-restore')
+            self.config.cache.set(self.config._in_progress_result_key('other-restore'), '<other/>')
+
+        with patch('casexml.apps.phone.restore.time.sleep', _sleep):
+            self.assertEqual('<other/>', self.config.get_payload())
+
+    def testTakesOverAfterLostPayload(self):
+        self.config.in_progress_wait = 5
+        self.config.cache.set(self.config._in_progress_key(), 'dead-restore')
+
+        def _sleep(seconds):
+            self.config.cache.delete(self.config._in_progress_key())
+
+        with patch('casexml.apps.phone.restore.time.sleep', _sleep):
+            self.assertTrue('mclovin' in self.config.get_payload())
+        self.assertEqual(None, self.config.cache.get(self.config._in_progress_key()))
+
+    def testLockReleased(self):
+        payload = self.config.get_payload()
+        self.assertTrue('mclovin' in payload)
+        self.assertEqual(None, self.config.cache.get(self.config._in_progress_key()))
+
+
+class AsyncRestoreTest(TestCase):
+
+    def setUp(self):
+        self.config = RestoreConfig(dummy_user(), version=V2, async_restore=True)
+        self.config.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.config.cache.clear()
+        self.async_restore = AsyncRestore(self.config)
+
+    def testRetryUntilGenerated(self):
+        with patch.object(AsyncRestore, '_start') as start:
+            response = self.config.get_response()
+            self.assertEqual(202, response.status_code)
+            self.assertEqual(str(AsyncRestore.retry_after), response['Retry-After'])
+            progress = self.async_restore.get_progress()
+            self.assertEqual((0, None), (progress['done'], progress['total']))
+            start.assert_called_once_with(progress['task'])
+
+            AsyncRestore(self.config, progress['task']).set_progress(100, 250)
+            response = self.config.get_response()
+            self.assertEqual(202, response.status_code)
+            self.assertTrue('100 of 250' in response.content)
+            # only started once
+            self.assertEqual(1, start.call_count)
+
+            # what the task does
+            task_config = RestoreConfig(dummy_user(), version=V2)
+            task_config.cache = self.config.cache
+            AsyncRestore(task_config, progress['task']).generate()
+            self.assertEqual(AsyncRestore.DONE, self.async_restore.get_progress()['status'])
+            response = self.config.get_response()
+            self.assertEqual(200, response.status_code)
+            self.assertTrue('mclovin' in response.content)
+
+            # served once, after that a new restore is started
+            self.assertEqual(202, self.config.get_response().status_code)
+            self.assertEqual(2, start.call_count)
+
+    def testRestartedWhenStale(self):
+        with patch.object(AsyncRestore, '_start') as start:
+            self.config.get_response()
+            self.assertEqual(1, start.call_count)
+
+            # the task died without clearing its progress
+            progress = self.async_restore.get_progress()
+            progress['updated'] -= AsyncRestore.stale_after + 1
+            self.config.cache.set(self.async_restore._get_key('progress'), progress)
+            self.assertEqual(202, self.config.get_response().status_code)
+            self.assertEqual(2, start.call_count)
+            self.assertFalse(self.async_restore._is_stale(self.async_restore.get_progress()))
+
+            # the restarted task isn't restarted again while it's making progress
+            self.config.get_response()
+            self.assertEqual(2, start.call_count)
+
+            # the old task can't publish over the new one
+            task_config = RestoreConfig(dummy_user(), version=V2)
+            task_config.cache = self.config.cache
+            AsyncRestore(task_config, progress['task']).generate()
+            self.assertEqual(AsyncRestore.RUNNING, self.async_restore.get_progress()['status'])
+            self.assertEqual(202, self.config.get_response().status_code)
+
+    def testGenerateFails(self):
+        with patch.object(AsyncRestore, '_start') as start:
+            self.config.get_response()
+            task = self.async_restore.get_progress()['task']
+
+            task_config = RestoreConfig(dummy_user(), version=V2)
+            task_config.cache = self.config.cache
+            with patch.object(RestoreConfig, '_generate_payload', side_effect=ValueError('boom')):
+                self.assertRaises(ValueError, AsyncRestore(task_config, task).generate)
+            self.assertEqual(AsyncRestore.FAILED, self.async_restore.get_progress()['status'])
+
+            # the failure is reported once instead of retrying forever
+            response = self.config.get_response()
+            self.assertEqual(412, response.status_code)
+            self.assertEqual(1, start.call_count)
+
+            # and the next request starts again
+            self.assertEqual(202, self.config.get_response().status_code)
+            self.assertEqual(2, start.call_count)
+
+    def testStockSettingsCanBePickled(self):
+        settings = pickle.loads(pickle.dumps(
+            StockSettings(consumption_config=ConsumptionConfiguration())))
+        self.assertEqual(None, settings.consumption_config.default_monthly_consumption_function('c', 'p'))
+        self.assertFalse(settings.force_consumption_case_filter(None))
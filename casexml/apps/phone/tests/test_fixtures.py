@@ -0,0 +1,102 @@
+import time
+from xml.etree import ElementTree
+from django.core.cache import get_cache
+from django.test import SimpleTestCase
+from casexml.apps.case.xml import V1, V2
+from casexml.apps.phone import xml
+from casexml.apps.phone.fixtures import FixtureGenerator, cached_fixture
+from casexml.apps.phone.models import User, SyncLog
+
+
+def _fixture_generator(name, delay):
+    def generator(user, version, last_sync):
+        time.sleep(delay)
+        return [ElementTree.Element('fixture', id=name)]
+    generator.__name__ = name
+    return generator
+
+
+class FixtureGeneratorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.user = User(user_id='fixture-user', username='fixture-user', password='changeme',
+                         date_joined=None)
+        self.generator = FixtureGenerator()
+        # the slowest generator comes first
+        self.generator._generator_funcs = [
+            _fixture_generator('slow', .05),
+            _fixture_generator('medium', .02),
+            _fixture_generator('fast', 0),
+        ]
+
+    def _check_fixtures(self, concurrency):
+        self.generator.concurrency = concurrency
+        fixtures, timings = self.generator.get_fixtures_with_timings(self.user, V2)
+        self.assertEqual(['slow', 'medium', 'fast'], [fixture.attrib['id'] for fixture in fixtures])
+        self.assertEqual(['slow', 'medium', 'fast'], [name.split('.')[-1] for name, _ in timings])
+        self.assertTrue(timings[0][1] >= .05)
+
+    def testSerial(self):
+        self._check_fixtures(1)
+
+    def testConcurrent(self):
+        self._check_fixtures(3)
+
+    def testV1(self):
+        self.assertEqual([], list(self.generator.get_fixtures(self.user, V1)))
+
+
+class CachedFixtureTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+        self.user = User(user_id='fixture-user', username='fixture-user', password='changeme',
+                         date_joined=None)
+        self.calls = []
+        self.data_version = 1
+
+        def _generator(user, version, last_sync):
+            self.calls.append(user.user_id)
+            return [ElementTree.Element('fixture', id='cached', version=str(self.data_version))]
+
+        self.cached_generator = cached_fixture(lambda user, version, last_sync: str(self.data_version))(_generator)
+        self.generator = FixtureGenerator()
+        self.generator._generator_funcs = [
+            _fixture_generator('uncached', 0),
+            self.cached_generator,
+        ]
+
+    def _get_fixtures(self, last_sync=None):
+        return self.generator.get_serialized_fixtures(self.user, V2, last_sync, self.cache)
+
+    def testCached(self):
+        fixtures, keys = self._get_fixtures()
+        self.assertEqual(2, len(fixtures))
+        self.assertEqual(xml.tostring(ElementTree.Element('fixture', id='uncached')), fixtures[0])
+        self.assertEqual(['1'], keys.values())
+        self.assertEqual(fixtures, self._get_fixtures()[0])
+        self.assertEqual(1, len(self.calls))
+
+        # a new key regenerates
+        self.data_version = 2
+        fixtures, _ = self._get_fixtures()
+        self.assertTrue('version="2"' in fixtures[1])
+        self.assertEqual(2, len(self.calls))
+
+    def testSkipUnchanged(self):
+        self.cached_generator.skip_unchanged = True
+        _, keys = self._get_fixtures()
+        last_sync = SyncLog(fixture_cache_keys=keys)
+        fixtures, skipped_keys = self._get_fixtures(last_sync)
+        self.assertEqual(1, len(fixtures))
+        self.assertEqual(keys, skipped_keys)
+
+        self.data_version = 2
+        self.assertEqual(2, len(self._get_fixtures(last_sync)[0]))
+
+    def testTimings(self):
+        fixtures, keys, timings = self.generator.get_serialized_fixtures_with_timings(
+            self.user, V2, None, self.cache)
+        self.assertEqual(2, len(fixtures))
+        self.assertEqual(['uncached', '_generator'], [name.split('.')[-1] for name, _ in timings])
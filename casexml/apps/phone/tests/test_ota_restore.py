@@ -9,12 +9,20 @@ from datetime import datetime, date
 from casexml.apps.phone.models import User, SyncLog
 from casexml.apps.phone import xml, views
 from django.contrib.auth.models import User as DjangoUser
-from casexml.apps.phone.restore import generate_restore_payload
+from casexml.apps.phone.restore import generate_restore_payload,\
+    generate_restore_response, RestoreConfig, StockSettings
 from django.http import HttpRequest
 from casexml.apps.phone.tests import const
 from casexml.apps.case import const as case_const
 from casexml.apps.phone.tests.dummy import dummy_restore_xml, dummy_user,\
     dummy_user_xml
+from casexml.apps.case.mock import CaseBlock
+from casexml.apps.case.util import post_case_blocks
+from casexml.apps.case.xml import V2
+from casexml.apps.stock.consumption import ConsumptionConfiguration
+from casexml.apps.stock.models import StockTransaction
+from casexml.apps.stock.tests.base import _stock_report
+from dimagi.utils.parsing import json_format_datetime
 
 class OtaRestoreTest(TestCase):
     """Tests OTA Restore"""
@@ -55,6 +63,20 @@ class OtaRestoreTest(TestCase):
             restore_payload,
         )
 
+    def testStreamingUserRestore(self):
+        response = generate_restore_response(dummy_user(), items=True, stream=True)
+        self.assertEqual(200, response.status_code)
+        sync_log = SyncLog.view(
+            "phone/sync_logs_by_user",
+            include_docs=True,
+            reduce=False,
+        ).one()
+        check_xml_line_by_line(
+            self,
+            dummy_restore_xml(sync_log.get_id, items=3),
+            ''.join(response.streaming_content),
+        )
+
     def testUserRestoreWithCase(self):
         file_path = os.path.join(os.path.dirname(__file__),
                                  "data", "create_short.xml")
@@ -406,3 +428,30 @@ class OtaRestoreTest(TestCase):
         # ghetto
         self.assertTrue('<dateattr somedate="2012-01-01">' in restore_payload)
         self.assertTrue('<stringattr somestring="i am a string">' in restore_payload)
+
+    def testRestoreWithStock(self):
+        case_id, product_id = 'stock-restore-case', 'stock-restore-product'
+        post_case_blocks([CaseBlock(create=True, case_id=case_id, user_id='foo',
+                                    owner_id='foo', version=V2).as_xml()])
+        _stock_report(case_id, product_id, 10, 1)
+        as_of = json_format_datetime(StockTransaction.objects.get(case_id=case_id).report.date)
+
+        config = RestoreConfig(dummy_user(), version=V2, stock_settings=StockSettings(
+            section_to_consumption_types={'stock': 'consumption'},
+            consumption_config=ConsumptionConfiguration(
+                default_monthly_consumption_function=lambda case_id, product_id: 5),
+        ))
+        restore_payload = config.get_payload()
+
+        # the same bytes as when the restore was serialized as one tree, with
+        # the stock namespace declared once on the root
+        self.assertTrue(restore_payload.startswith(
+            '<OpenRosaResponse xmlns:ns0="http://commtrack.org/stock_report" '))
+        self.assertEqual(1, restore_payload.count('xmlns:ns0='))
+        expected_balances = (
+            '<ns0:balance date="{date}" entity-id="{case}" section-id="stock">'
+            '<ns0:entry id="{product}" quantity="10" /></ns0:balance>'
+            '<ns0:balance date="{date}" entity-id="{case}" section-id="consumption">'
+            '<ns0:entry id="{product}" quantity="5" /></ns0:balance>'
+        ).format(date=as_of, case=case_id, product=product_id)
+        self.assertTrue(expected_balances in restore_payload)
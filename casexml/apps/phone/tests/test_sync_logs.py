@@ -1,6 +1,8 @@
+from mock import patch
 from django.test import TestCase
 from casexml.apps.case.tests.util import delete_all_sync_logs
 from casexml.apps.case.xml import V1, V2
+from casexml.apps.phone.checksum import Checksum, CaseStateHash
 from casexml.apps.phone.models import SyncLog, CaseState
 from casexml.apps.case.sharedmodels import CommCareCaseIndex
 
@@ -73,6 +75,130 @@ class PhoneFootprintTest(TestCase):
         log.archive_case("c1")
         self.assertEqual(0, len(log.get_footprint_of_cases_on_phone()))
 
+    def test_phone_is_holding_case(self):
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1",
+                                                indices=[CommCareCaseIndex(identifier="d1-id",
+                                                                           referenced_id="d1")])],
+                      dependent_cases_on_phone=[CaseState(case_id="d1", indices=[]),
+                                                CaseState(case_id="d2", indices=[])])
+        self.assertTrue(log.phone_is_holding_case("c1"))
+        self.assertTrue(log.phone_is_holding_case("d1"))
+        self.assertFalse(log.phone_is_holding_case("d2"))
+        self.assertFalse(log.phone_is_holding_case("missing"))
+
+        log.archive_case("c1")
+        self.assertFalse(log.phone_is_holding_case("c1"))
+        self.assertFalse(log.phone_is_holding_case("d1"))
+
+    def test_footprint_after_index_changed_in_place(self):
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1", indices=[])],
+                      dependent_cases_on_phone=[CaseState(case_id="d1", indices=[])])
+        self.assertFalse(log.phone_is_holding_case("d1"))
+
+        log.get_case_state("c1").update_indices([CommCareCaseIndex(identifier="d1-id",
+                                                                   referenced_id="d1")])
+        self.assertTrue(log.phone_is_holding_case("d1"))
+
+        log.get_case_state("c1").update_indices([CommCareCaseIndex(identifier="d1-id",
+                                                                   referenced_id="")])
+        self.assertFalse(log.phone_is_holding_case("d1"))
+
+    def test_incremental_state_hash(self):
+        def _expected_hash(log):
+            return CaseStateHash(Checksum(list(log.get_footprint_of_cases_on_phone())).hexdigest())
+
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1",
+                                                indices=[CommCareCaseIndex(identifier="d1-id",
+                                                                           referenced_id="d1")]),
+                                      CaseState(case_id="c2", indices=[])],
+                      dependent_cases_on_phone=[CaseState(case_id="d1", indices=[])])
+        self.assertEqual(_expected_hash(log), log.get_state_hash())
+
+        log.archive_case("c2")
+        self.assertEqual(_expected_hash(log), log.get_state_hash())
+
+        log.cases_on_phone.append(CaseState(case_id="c3", indices=[]))
+        self.assertEqual(_expected_hash(log), log.get_state_hash())
+
+        log.archive_case("c1")
+        log.archive_case("c3")
+        self.assertEqual(CaseStateHash(""), log.get_state_hash())
+
+        # the hash is stored with the log
+        log.cases_on_phone.append(CaseState(case_id="c4", indices=[]))
+        log.save()
+        self.assertEqual(_expected_hash(log), SyncLog.get(log._id).get_state_hash())
+
+    def test_state_hash_dropped_after_direct_changes(self):
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1", indices=[]),
+                                      CaseState(case_id="c2", indices=[])])
+        log.get_state_hash()
+        log.save()
+
+        # changes made through the log keep the stored hash up to date
+        log = SyncLog.get(log._id)
+        log.archive_case("c1")
+        log.save()
+        log = SyncLog.get(log._id)
+        self.assertEqual(Checksum(["c2"]).hexdigest(), log.footprint_hash)
+
+        # direct changes drop it instead of saving a stale one
+        log.cases_on_phone.append(CaseState(case_id="c3", indices=[]))
+        log.save()
+        log = SyncLog.get(log._id)
+        self.assertEqual(None, log.footprint_hash)
+        self.assertEqual(CaseStateHash(Checksum(["c2", "c3"]).hexdigest()),
+                         log.get_state_hash())
+
+    def test_stored_state_hash_used(self):
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1", indices=[]),
+                                      CaseState(case_id="c2", indices=[])])
+        log.get_state_hash()
+        log.save()
+
+        log = SyncLog.get(log._id)
+        with patch.object(SyncLog, '_compute_footprint') as compute_footprint:
+            log.archive_case("c1")
+            self.assertEqual(CaseStateHash(Checksum(["c2"]).hexdigest()), log.get_state_hash())
+            log.save()
+            self.assertFalse(compute_footprint.called)
+
+    def test_archive_referenced_case(self):
+        # c2 references c1, so c1 stays in the footprint when it's archived
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1", indices=[]),
+                                      CaseState(case_id="c2",
+                                                indices=[CommCareCaseIndex(identifier="c1-id",
+                                                                           referenced_id="c1")])])
+        log.get_state_hash()
+        log.archive_case("c1")
+        self.assertEqual(CaseStateHash(Checksum(["c1", "c2"]).hexdigest()), log.get_state_hash())
+
+    def test_case_state_lookup(self):
+        log = SyncLog(cases_on_phone=[CaseState(case_id="c1", indices=[])],
+                      dependent_cases_on_phone=[CaseState(case_id="d1", indices=[])])
+        self.assertTrue(log.phone_has_case("c1"))
+        self.assertFalse(log.phone_has_case("c2"))
+        self.assertTrue(log.phone_has_dependent_case("d1"))
+
+        # direct changes to the lists are picked up
+        log.cases_on_phone.append(CaseState(case_id="c2", indices=[]))
+        self.assertTrue(log.phone_has_case("c2"))
+
+        log.archive_case("c1")
+        self.assertFalse(log.phone_has_case("c1"))
+        self.assertTrue(log.phone_has_dependent_case("c1"))
+
+        # index updates are visible through subsequent lookups
+        log.get_case_state("c2").update_indices([CommCareCaseIndex(identifier="d1-id",
+                                                                   referenced_id="d1")])
+        self.assertEqual("d1", log.get_case_state("c2").indices[0].referenced_id)
+
+        log.cases_on_phone.append(CaseState(case_id="c3", indices=[]))
+        log.cases_on_phone.append(CaseState(case_id="c3", indices=[]))
+        log.reconcile_cases()
+        self.assertTrue(log.phone_has_case("c3"))
+        self.assertTrue(log.phone_has_dependent_case("d1"))
+
     def testCachingResponse(self):
         log = SyncLog()
         log.save()
@@ -9,6 +9,9 @@ from casexml.apps.case.tests.util import (check_user_has_case, delete_all_sync_l
     delete_all_xforms, delete_all_cases, assert_user_doesnt_have_case,
     assert_user_has_case)
 from casexml.apps.case import process_cases
+from casexml.apps.phone import caselogic
+from casexml.apps.phone.caselogic import get_incremental_case_updates, \
+    filter_case_ids_modified_elsewhere_since_sync, get_changed_case_ids
 from casexml.apps.phone.models import SyncLog, User
 from casexml.apps.phone.restore import generate_restore_payload, RestoreConfig
 from dimagi.utils.parsing import json_format_datetime
@@ -358,6 +361,22 @@ class SyncTokenUpdateTest(SyncBaseTest):
         form.archive()
         assert_user_has_case(self, self.user, case_id, restore_id=self.sync_log.get_id)
 
+    def testSyncOperationCaseSets(self):
+        self._createCaseStubs(["sync_op_synced"])
+        # created without the sync token so the phone doesn't have it
+        post_case_blocks([CaseBlock(create=True, case_id="sync_op_elsewhere", user_id=OTHER_USER_ID,
+                                    owner_id=USER_ID, case_type=PARENT_TYPE, version=V2).as_xml()])
+        sync_operation = self.user.get_case_updates(SyncLog.get(self.sync_log.get_id))
+
+        def _ids(cases):
+            return set(case.get_id for case in cases)
+        both = set(["sync_op_synced", "sync_op_elsewhere"])
+        self.assertEqual(both, _ids(sync_operation.actual_relevant_cases))
+        self.assertEqual(set(["sync_op_synced"]), _ids(sync_operation.phone_relevant_cases))
+        self.assertEqual(both, _ids(sync_operation.all_potential_cases))
+        self.assertEqual(set(["sync_op_elsewhere"]), _ids(sync_operation.all_potential_to_sync))
+        self.assertEqual(["sync_op_elsewhere"], sync_operation.all_potential_to_sync_dict.keys())
+
 
 class SyncTokenCachingTest(SyncBaseTest):
 
@@ -988,3 +1007,108 @@ class SyncTokenReprocessingTest(SyncBaseTest):
         except AssertionError:
             # this should fail because it's a true error
             pass
+
+
+class IncrementalSyncTest(SyncBaseTest):
+    """
+    Tests that incremental syncs come up with the same cases as full syncs
+    """
+
+    def _assertMatchesFullSync(self, sync_log):
+        sync_log = SyncLog.get(sync_log.get_id)
+        full = self.user.get_case_updates(sync_log)
+        incremental = get_incremental_case_updates(self.user, sync_log)
+        self.assertNotEqual(None, incremental)
+        self.assertEqual(set(update.case.get_id for update in full.actual_cases_to_sync),
+                         set(update.case.get_id for update in incremental.actual_cases_to_sync))
+        self.assertEqual(set(state.case_id for state in full.get_owned_case_states()),
+                         set(state.case_id for state in incremental.get_owned_case_states()))
+        self.assertEqual(set(state.case_id for state in full.get_extended_case_states()),
+                         set(state.case_id for state in incremental.get_extended_case_states()))
+        return incremental
+
+    def testNoChanges(self):
+        self._createCaseStubs(["incremental_unchanged"])
+        sync_log = synclog_from_restore_payload(generate_restore_payload(self.user, self.sync_log.get_id))
+        incremental = self._assertMatchesFullSync(sync_log)
+        self.assertEqual([], incremental.actual_cases_to_sync)
+
+    def testChanges(self):
+        parent_id, child_id, edited_id = "incremental_parent", "incremental_child", "incremental_edited"
+        self._createCaseStubs([edited_id])
+        sync_log = synclog_from_restore_payload(generate_restore_payload(self.user, self.sync_log.get_id))
+
+        # someone else creates a child (of a case the user doesn't own) for
+        # the user and edits one of the user's cases
+        self._postFakeWithSyncToken(
+            CaseBlock(create=True, case_id=parent_id, user_id=OTHER_USER_ID, owner_id=OTHER_USER_ID,
+                      case_type=PARENT_TYPE, version=V2).as_xml(), None)
+        self._postFakeWithSyncToken(
+            CaseBlock(create=True, case_id=child_id, user_id=OTHER_USER_ID, owner_id=USER_ID,
+                      case_type=PARENT_TYPE, index={'mother': (PARENT_TYPE, parent_id)},
+                      version=V2).as_xml(), None)
+        self._postFakeWithSyncToken(
+            CaseBlock(create=False, case_id=edited_id, user_id=OTHER_USER_ID,
+                      version=V2, update={'greeting': "Hello!"}).as_xml(), None)
+
+        incremental = self._assertMatchesFullSync(sync_log)
+        synced_ids = set(update.case.get_id for update in incremental.actual_cases_to_sync)
+        self.assertTrue(parent_id in synced_ids)
+        self.assertTrue(child_id in synced_ids)
+
+    def testOwnerIdsChanged(self):
+        sync_log = SyncLog.get(self.sync_log.get_id)
+        self.user.additional_owner_ids = [SHARED_ID]
+        self.assertEqual(None, get_incremental_case_updates(self.user, sync_log))
+
+    def testChangesFilteredByDomain(self):
+        since = CommCareCase.get_db().info()['update_seq']
+        for case_id, domain in (("incremental_in_domain", "incremental-domain"),
+                                ("incremental_other_domain", "incremental-other-domain")):
+            post_case_blocks(
+                [CaseBlock(create=True, case_id=case_id, user_id=USER_ID, owner_id=USER_ID,
+                           case_type=PARENT_TYPE, version=V2).as_xml()],
+                form_extras={"domain": domain}
+            )
+        self.assertEqual(set(["incremental_in_domain"]),
+                         get_changed_case_ids(since, domain="incremental-domain"))
+        self.assertEqual(set(["incremental_in_domain", "incremental_other_domain"]),
+                         get_changed_case_ids(since))
+
+
+class CaseModificationLookupTest(SyncBaseTest):
+
+    def testDomainLookupMatches(self):
+        domain = 'modification-lookup'
+        unchanged_id, edited_id, new_id = "lookup_unchanged", "lookup_edited", "lookup_new"
+        for case_id in (unchanged_id, edited_id):
+            post_case_blocks(
+                [CaseBlock(create=True, case_id=case_id, user_id=USER_ID, owner_id=USER_ID,
+                           case_type=PARENT_TYPE, version=V2).as_xml()],
+                form_extras={"domain": domain, "last_sync_token": self.sync_log.get_id}
+            )
+        sync_log = synclog_from_restore_payload(generate_restore_payload(self.user, self.sync_log.get_id))
+        post_case_blocks(
+            [CaseBlock(create=False, case_id=edited_id, user_id=OTHER_USER_ID,
+                       version=V2, update={'greeting': "Hello!"}).as_xml(),
+             CaseBlock(create=True, case_id=new_id, user_id=OTHER_USER_ID, owner_id=USER_ID,
+                       case_type=PARENT_TYPE, version=V2).as_xml()],
+            form_extras={"domain": domain}
+        )
+
+        sync_log = SyncLog.get(sync_log.get_id)
+        case_ids = [unchanged_id, edited_id, new_id]
+        by_domain = filter_case_ids_modified_elsewhere_since_sync(case_ids, sync_log, domain)
+        self.assertEqual(filter_case_ids_modified_elsewhere_since_sync(case_ids, sync_log), by_domain)
+        self.assertTrue(unchanged_id not in by_domain)
+        self.assertTrue(new_id in by_domain)
+
+        # past the limit the modifications are looked up for each case instead
+        self.assertEqual(None, caselogic._get_case_ids_modified_since(domain, sync_log, limit=1))
+        max_modifications = caselogic.MAX_DOMAIN_MODIFICATIONS
+        caselogic.MAX_DOMAIN_MODIFICATIONS = 1
+        try:
+            self.assertEqual(by_domain,
+                             filter_case_ids_modified_elsewhere_since_sync(case_ids, sync_log, domain))
+        finally:
+            caselogic.MAX_DOMAIN_MODIFICATIONS = max_modifications
@@ -1,13 +1,19 @@
 import collections
 import functools
 import math
+from django.db.models import Count
 from dimagi.utils import parsing as dateparse
 from datetime import datetime, timedelta
 from casexml.apps.stock import const
 from casexml.apps.stock.models import StockTransaction
 from dimagi.utils.dates import force_to_datetime
 
-DEFAULT_CONSUMPTION_FUNCTION = lambda case_id, product_id: None
+def default_consumption_function(case_id, product_id):
+    return None
+
+# a module level function rather than a lambda so that configurations can
+# be pickled
+DEFAULT_CONSUMPTION_FUNCTION = default_consumption_function
 
 class ConsumptionConfiguration(object):
     DEFAULT_MIN_PERIODS = 2
@@ -123,26 +129,28 @@ def compute_default_monthly_consumption(case_id, product_id, configuration):
     )
 
 
+# todo: get rid of this middle layer once the consumption calc has
+# been updated to deal with the regular transaction objects
+SimpleTransaction = collections.namedtuple('SimpleTransaction', ['action', 'value', 'received_on'])
+
+
+def _to_consumption_tx(txn):
+    if txn.type in (const.TRANSACTION_TYPE_STOCKONHAND, const.TRANSACTION_TYPE_STOCKOUT):
+        value = txn.stock_on_hand
+    else:
+        assert txn.type in (const.TRANSACTION_TYPE_RECEIPTS, const.TRANSACTION_TYPE_CONSUMPTION)
+        value = math.fabs(txn.quantity)
+    return SimpleTransaction(
+        action=txn.type,
+        value=value,
+        received_on=txn.report.date,
+    )
+
+
 def get_transactions(case_id, product_id, section_id, window_start, window_end):
     """
     Given a case/product pair, get transactions in a format ready for consumption calc
     """
-    # todo: get rid of this middle layer once the consumption calc has
-    # been updated to deal with the regular transaction objects
-    SimpleTransaction = collections.namedtuple('SimpleTransaction', ['action', 'value', 'received_on'])
-
-    def _to_consumption_tx(txn):
-        if txn.type in (const.TRANSACTION_TYPE_STOCKONHAND, const.TRANSACTION_TYPE_STOCKOUT):
-            value = txn.stock_on_hand
-        else:
-            assert txn.type in (const.TRANSACTION_TYPE_RECEIPTS, const.TRANSACTION_TYPE_CONSUMPTION)
-            value = math.fabs(txn.quantity)
-        return SimpleTransaction(
-            action=txn.type,
-            value=value,
-            received_on=txn.report.date,
-        )
-
     # todo: beginning of window date filtering
     db_transactions = StockTransaction.objects.filter(
         case_id=case_id, product_id=product_id,
@@ -164,6 +172,93 @@ def get_transactions(case_id, product_id, section_id, window_start, window_end):
         yield _to_consumption_tx(db_tx)
 
 
+def bulk_get_transactions(keys, window_start, window_end):
+    """
+    Like get_transactions, but for many (case_id, product_id, section_id)
+    keys at once, using at most two queries.
+
+    Returns a dict of key -> list of transactions ready for consumption calc.
+    Keys without any transactions in the window are left out.
+    """
+    keys = set(keys)
+    if not keys:
+        return {}
+
+    peers = StockTransaction.objects.filter(
+        case_id__in=set(case_id for case_id, _, _ in keys),
+        product_id__in=set(product_id for _, product_id, _ in keys),
+        section_id__in=set(section_id for _, _, section_id in keys),
+    )
+    db_transactions = peers.filter(
+        report__date__gt=window_start,
+        report__date__lte=force_to_datetime(window_end),
+    ).select_related('report').order_by('report__date', 'pk')
+
+    transactions_by_key = collections.defaultdict(list)
+    for db_tx in db_transactions:
+        key = (db_tx.case_id, db_tx.product_id, db_tx.section_id)
+        # the filter above is a cross product of the keys, so skip extras
+        if key in keys:
+            transactions_by_key[key].append(db_tx)
+
+    # get_transactions repeats the first transaction in the window whenever
+    # there are any others for the key. that's only in question when there
+    # is just one transaction in the window
+    single_keys = set(key for key, txs in transactions_by_key.items() if len(txs) == 1)
+    keys_with_others = set()
+    if single_keys:
+        counts = peers.filter(
+            case_id__in=set(case_id for case_id, _, _ in single_keys),
+        ).values('case_id', 'product_id', 'section_id').annotate(count=Count('pk'))
+        for row in counts:
+            key = (row['case_id'], row['product_id'], row['section_id'])
+            if key in single_keys and row['count'] > 1:
+                keys_with_others.add(key)
+
+    ret = {}
+    for key, db_txs in transactions_by_key.items():
+        txs = [_to_consumption_tx(db_tx) for db_tx in db_txs]
+        if len(txs) > 1 or key in keys_with_others:
+            txs.insert(0, txs[0])
+        ret[key] = txs
+    return ret
+
+
+def bulk_compute_consumption(keys, window_end, configuration=None):
+    """
+    Computes consumption for many (case_id, product_id, section_id) keys
+    at once, loading all the relevant transactions up front.
+
+    Returns a dict of key -> consumption, which is None where there is
+    insufficient history.
+    """
+    configuration = configuration or ConsumptionConfiguration()
+    window_start = window_end - timedelta(days=configuration.max_window)
+    transactions = bulk_get_transactions(keys, window_start, window_end)
+    return dict(
+        (key, compute_consumption_from_transactions(
+            transactions.get(key, []), window_start, configuration
+        ))
+        for key in keys
+    )
+
+
+def bulk_compute_consumption_or_default(keys, window_end, configuration=None):
+    """
+    Bulk version of compute_consumption_or_default
+    """
+    configuration = configuration or ConsumptionConfiguration()
+    consumption = bulk_compute_consumption(keys, window_end, configuration)
+    ret = {}
+    for key, value in consumption.items():
+        if value:
+            ret[key] = value
+        else:
+            case_id, product_id, _ = key
+            ret[key] = compute_default_monthly_consumption(case_id, product_id, configuration)
+    return ret
+
+
 def compute_consumption_from_transactions(transactions, window_start, configuration=None):
     configuration = configuration or ConsumptionConfiguration()
 
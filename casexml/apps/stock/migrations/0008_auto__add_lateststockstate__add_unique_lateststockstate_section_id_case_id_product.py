@@ -0,0 +1,74 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'LatestStockState'
+        db.create_table(u'stock_lateststockstate', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('section_id', self.gf('django.db.models.fields.CharField')(max_length=100, db_index=True)),
+            ('case_id', self.gf('django.db.models.fields.CharField')(max_length=100, db_index=True)),
+            ('product_id', self.gf('django.db.models.fields.CharField')(max_length=100, db_index=True)),
+            ('stock_on_hand', self.gf('django.db.models.fields.DecimalField')(max_digits=20, decimal_places=5)),
+            ('last_report_date', self.gf('django.db.models.fields.DateTimeField')()),
+            ('transaction', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['stock.StockTransaction'])),
+        ))
+        db.send_create_signal(u'stock', ['LatestStockState'])
+
+        # Adding unique constraint on 'LatestStockState', fields ['section_id', 'case_id', 'product_id']
+        db.create_unique(u'stock_lateststockstate', ['section_id', 'case_id', 'product_id'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'LatestStockState', fields ['section_id', 'case_id', 'product_id']
+        db.delete_unique(u'stock_lateststockstate', ['section_id', 'case_id', 'product_id'])
+
+        # Deleting model 'LatestStockState'
+        db.delete_table(u'stock_lateststockstate')
+
+
+    models = {
+        u'stock.docdomainmapping': {
+            'Meta': {'object_name': 'DocDomainMapping'},
+            'doc_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'primary_key': 'True', 'db_index': 'True'}),
+            'doc_type': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'domain_name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'})
+        },
+        u'stock.lateststockstate': {
+            'Meta': {'unique_together': "(('section_id', 'case_id', 'product_id'),)", 'object_name': 'LatestStockState'},
+            'case_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_report_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'product_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'section_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'stock_on_hand': ('django.db.models.fields.DecimalField', [], {'max_digits': '20', 'decimal_places': '5'}),
+            'transaction': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['stock.StockTransaction']"})
+        },
+        u'stock.stockreport': {
+            'Meta': {'object_name': 'StockReport'},
+            'date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'form_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        },
+        u'stock.stocktransaction': {
+            'Meta': {'object_name': 'StockTransaction'},
+            'case_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'product_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'quantity': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '20', 'decimal_places': '5'}),
+            'report': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['stock.StockReport']"}),
+            'section_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'stock_on_hand': ('django.db.models.fields.DecimalField', [], {'max_digits': '20', 'decimal_places': '5'}),
+            'subtype': ('django.db.models.fields.CharField', [], {'max_length': '20', 'null': 'True', 'blank': 'True'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        }
+    }
+
+    complete_apps = ['stock']
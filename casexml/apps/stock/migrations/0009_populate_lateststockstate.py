@@ -0,0 +1,74 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from dimagi.utils.chunked import chunked
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        # walk the history in order so that the last transaction seen for
+        # each ledger is the latest one
+        latest = {}
+        transactions = orm.StockTransaction.objects.select_related('report').order_by('report__date', 'pk')
+        for txn in transactions.iterator():
+            latest[(txn.case_id, txn.section_id, txn.product_id)] = txn
+
+        for chunk in chunked(latest.values(), 1000):
+            orm.LatestStockState.objects.bulk_create([
+                orm.LatestStockState(
+                    case_id=txn.case_id,
+                    section_id=txn.section_id,
+                    product_id=txn.product_id,
+                    stock_on_hand=txn.stock_on_hand,
+                    last_report_date=txn.report.date,
+                    transaction=txn,
+                ) for txn in chunk
+            ])
+
+
+    def backwards(self, orm):
+        orm.LatestStockState.objects.all().delete()
+
+
+    models = {
+        u'stock.docdomainmapping': {
+            'Meta': {'object_name': 'DocDomainMapping'},
+            'doc_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'primary_key': 'True', 'db_index': 'True'}),
+            'doc_type': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'domain_name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'})
+        },
+        u'stock.lateststockstate': {
+            'Meta': {'unique_together': "(('section_id', 'case_id', 'product_id'),)", 'object_name': 'LatestStockState'},
+            'case_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_report_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'product_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'section_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'stock_on_hand': ('django.db.models.fields.DecimalField', [], {'max_digits': '20', 'decimal_places': '5'}),
+            'transaction': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['stock.StockTransaction']"})
+        },
+        u'stock.stockreport': {
+            'Meta': {'object_name': 'StockReport'},
+            'date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'form_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        },
+        u'stock.stocktransaction': {
+            'Meta': {'object_name': 'StockTransaction'},
+            'case_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'product_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'quantity': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '20', 'decimal_places': '5'}),
+            'report': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['stock.StockReport']"}),
+            'section_id': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'stock_on_hand': ('django.db.models.fields.DecimalField', [], {'max_digits': '20', 'decimal_places': '5'}),
+            'subtype': ('django.db.models.fields.CharField', [], {'max_length': '20', 'null': 'True', 'blank': 'True'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        }
+    }
+
+    complete_apps = ['stock']
+    symmetrical = True
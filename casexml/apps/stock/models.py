@@ -1,5 +1,7 @@
-from django.db import models
-from django.db.models.signals import pre_save
+from collections import defaultdict
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from casexml.apps.stock import const
 from decimal import Decimal
@@ -20,6 +22,60 @@ class StockReport(models.Model):
     def __unicode__(self):
         return '{type} on {date} ({form})'.format(type=self.type, date=self.date, form=self.form_id)
 
+    def bulk_save_transactions(self, transactions):
+        """
+        Saves a list of new transactions against this report using a fixed
+        number of queries. Creates the same inferred transactions, in the
+        same order, as saving the transactions one at a time does.
+        """
+        keys = set((txn.case_id, txn.section_id, txn.product_id) for txn in transactions)
+        with transaction.commit_on_success():
+            # the states are locked until the transactions are saved so
+            # that the inferred transactions are based on the current stock
+            states = {}
+            for state in LatestStockState.objects.select_for_update().filter(
+                    case_id__in=set(case_id for case_id, _, _ in keys),
+                    product_id__in=set(product_id for _, _, product_id in keys)):
+                key = (state.case_id, state.section_id, state.product_id)
+                if key in keys:
+                    states[key] = state
+
+            def _is_latest(key):
+                # whether a transaction in this report would be the new latest
+                # transaction for the ledger
+                return key not in states or self.date >= states[key].last_report_date
+
+            previous_soh = dict((key, state.stock_on_hand) for key, state in states.items())
+            to_save = []
+            for txn in transactions:
+                assert txn.pk is None
+                txn.report = self
+                key = (txn.case_id, txn.section_id, txn.product_id)
+                if txn.type == const.TRANSACTION_TYPE_STOCKONHAND and key in previous_soh:
+                    inferred = txn.get_inferred_transaction(previous_soh[key])
+                    if inferred:
+                        to_save.append(inferred)
+                to_save.append(txn)
+                if _is_latest(key):
+                    previous_soh[key] = txn.stock_on_hand
+
+            StockTransaction.objects.bulk_create(to_save)
+
+            # bulk_create doesn't send signals so update the ledger states
+            # here, with the same conditional update as the signal so that a
+            # state another process has moved on to a later transaction is
+            # left alone
+            latest = {}
+            for txn in StockTransaction.objects.filter(report=self).select_related('report').order_by('pk'):
+                key = (txn.case_id, txn.section_id, txn.product_id)
+                if key in keys:
+                    latest[key] = txn
+            for key, txn in latest.items():
+                if key in states:
+                    LatestStockState.move_to_transaction(states[key].pk, txn)
+                else:
+                    LatestStockState.update_for_transaction(txn)
+
 class StockTransaction(models.Model):
     report = models.ForeignKey(StockReport)
 
@@ -44,17 +100,59 @@ class StockTransaction(models.Model):
             case=self.case_id, product=self.product_id, section_id=self.section_id,
         )
 
+    def get_inferred_transaction(self, previous_stock_on_hand):
+        """
+        The unsaved consumption or receipt transaction implied by this stock
+        on hand transaction following the previous stock on hand, if any.
+        """
+        # only soh reports that have changed the stock create inferred transactions
+        if previous_stock_on_hand != self.stock_on_hand:
+            amt = self.stock_on_hand - Decimal(previous_stock_on_hand)
+            return StockTransaction(
+                report=self.report,
+                case_id=self.case_id,
+                section_id=self.section_id,
+                product_id=self.product_id,
+                type=const.TRANSACTION_TYPE_CONSUMPTION if amt < 0 else const.TRANSACTION_TYPE_RECEIPTS,
+                quantity=amt,
+                stock_on_hand=self.stock_on_hand,
+                subtype=const.TRANSACTION_SUBTYPE_INFERRED,
+            )
+
     def get_previous_transaction(self):
-        siblings = StockTransaction._peer_qs(self.case_id, self.section_id, self.product_id).exclude(pk=self.pk)
-        if siblings.count():
-            return siblings[0]
+        latest = StockTransaction.latest(self.case_id, self.section_id, self.product_id)
+        if latest is not None and latest.pk == self.pk:
+            # this is the latest transaction so we have to look at the history
+            siblings = StockTransaction._peer_qs(self.case_id, self.section_id, self.product_id).exclude(pk=self.pk)
+            if siblings.count():
+                return siblings[0]
+            return None
+        return latest
 
     @classmethod
     def latest(cls, case_id, section_id, product_id):
-        relevant = cls._peer_qs(case_id, section_id, product_id)
-        if relevant.count():
-            return relevant.select_related()[0]
-        return None
+        try:
+            return LatestStockState.objects.select_related('transaction__report').get(
+                case_id=case_id, section_id=section_id, product_id=product_id
+            ).transaction
+        except LatestStockState.DoesNotExist:
+            return None
+
+    @classmethod
+    def latest_for_cases(cls, case_ids):
+        """
+        Gets the latest transaction for every (case, section, product)
+        combination in a set of cases in a single query.
+
+        Returns a dict of {case_id: {section_id: {product_id: transaction}}}
+        """
+        states = LatestStockState.objects.filter(
+            case_id__in=case_ids
+        ).select_related('transaction__report')
+        ret = defaultdict(lambda: defaultdict(dict))
+        for state in states:
+            ret[state.case_id][state.section_id][state.product_id] = state.transaction
+        return ret
 
     @classmethod
     def _peer_qs(self, case_id, section_id, product_id):
@@ -62,6 +160,78 @@ class StockTransaction(models.Model):
             case_id=case_id, product_id=product_id, section_id=section_id).order_by('-report__date', '-pk')
 
 
+class LatestStockState(models.Model):
+    """
+    The current state of a (case, section, product) ledger, kept up to date
+    as transactions are saved so the latest transaction doesn't have to be
+    looked up by ordering the whole history.
+    """
+    section_id = models.CharField(max_length=100, db_index=True)
+    case_id = models.CharField(max_length=100, db_index=True)
+    product_id = models.CharField(max_length=100, db_index=True)
+
+    stock_on_hand = models.DecimalField(max_digits=20, decimal_places=5)
+    last_report_date = models.DateTimeField()
+    transaction = models.ForeignKey(StockTransaction)
+
+    class Meta:
+        unique_together = ('section_id', 'case_id', 'product_id')
+
+    def __unicode__(self):
+        return '{soh} as of {date} (case: {case}, product: {product}, section id: {section_id})'.format(
+            soh=self.stock_on_hand, date=self.last_report_date,
+            case=self.case_id, product=self.product_id, section_id=self.section_id,
+        )
+
+    @classmethod
+    def update_for_transaction(cls, txn):
+        """
+        Moves the state for the transaction's ledger on to the transaction,
+        unless the ledger already has a later one.
+        """
+        date = txn.report.date
+        state, created = cls.objects.get_or_create(
+            case_id=txn.case_id,
+            section_id=txn.section_id,
+            product_id=txn.product_id,
+            defaults={
+                'transaction': txn,
+                'stock_on_hand': txn.stock_on_hand,
+                'last_report_date': date,
+            }
+        )
+        if not created:
+            cls.move_to_transaction(state.pk, txn)
+
+    @classmethod
+    def move_to_transaction(cls, pk, txn):
+        """
+        Moves an existing state on to the transaction, unless it already
+        has a later one.
+        """
+        date = txn.report.date
+        # the ordering check is part of the update so that concurrent
+        # saves can't move the state back to an older transaction
+        cls.objects.filter(pk=pk).filter(
+            Q(last_report_date__lt=date) |
+            Q(last_report_date=date, transaction__lte=txn.pk)
+        ).update(
+            transaction=txn,
+            stock_on_hand=txn.stock_on_hand,
+            last_report_date=date,
+        )
+
+    @classmethod
+    def rebuild(cls, case_id, section_id, product_id):
+        """
+        Recomputes the state for a ledger from its transaction history.
+        """
+        cls.objects.filter(case_id=case_id, section_id=section_id, product_id=product_id).delete()
+        history = StockTransaction._peer_qs(case_id, section_id, product_id).select_related('report')
+        if history.count():
+            cls.update_for_transaction(history[0])
+
+
 class DocDomainMapping(models.Model):
     """
     Used to store the relationship between a doc and the
@@ -78,16 +248,17 @@ def create_reconciliation_transaction(sender, instance, *args, **kwargs):
     creating = instance.pk is None
     if creating and instance.type == const.TRANSACTION_TYPE_STOCKONHAND:
         previous_transaction = instance.get_previous_transaction()
-        # only soh reports that have changed the stock create inferred transactions
-        if previous_transaction and previous_transaction.stock_on_hand != instance.stock_on_hand:
-            amt = instance.stock_on_hand - Decimal(previous_transaction.stock_on_hand)
-            StockTransaction.objects.create(
-                report=instance.report,
-                case_id=instance.case_id,
-                section_id=instance.section_id,
-                product_id=instance.product_id,
-                type=const.TRANSACTION_TYPE_CONSUMPTION if amt < 0 else const.TRANSACTION_TYPE_RECEIPTS,
-                quantity=amt,
-                stock_on_hand=instance.stock_on_hand,
-                subtype=const.TRANSACTION_SUBTYPE_INFERRED,
-            )
+        if previous_transaction:
+            inferred = instance.get_inferred_transaction(previous_transaction.stock_on_hand)
+            if inferred:
+                inferred.save()
+
+
+@receiver(post_save, sender=StockTransaction)
+def update_latest_stock_state(sender, instance, *args, **kwargs):
+    LatestStockState.update_for_transaction(instance)
+
+
+@receiver(post_delete, sender=StockTransaction)
+def rebuild_latest_stock_state(sender, instance, *args, **kwargs):
+    LatestStockState.rebuild(instance.case_id, instance.section_id, instance.product_id)
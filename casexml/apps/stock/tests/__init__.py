@@ -1,3 +1,4 @@
 from .test_consumption_calc import *
 from .test_consumption_for_case import *
 from .test_inferred_transactions import *
+from .test_latest_transactions import *
@@ -1,6 +1,9 @@
-from casexml.apps.stock.consumption import ConsumptionConfiguration, compute_consumption, compute_consumption_or_default
+import uuid
+from casexml.apps.stock import const
+from casexml.apps.stock.consumption import ConsumptionConfiguration, compute_consumption, compute_consumption_or_default, \
+    bulk_compute_consumption, bulk_compute_consumption_or_default
 from casexml.apps.stock.tests.mock_consumption import now
-from casexml.apps.stock.tests.base import StockTestBase
+from casexml.apps.stock.tests.base import StockTestBase, _stock_report
 
 
 class ConsumptionCaseTest(StockTestBase):
@@ -37,3 +40,34 @@ class ConsumptionCaseTest(StockTestBase):
                 default_monthly_consumption_function=_ten
             )
         ))
+
+    def testBulkConsumption(self):
+        self._stock_report(25, 5)
+        self._stock_report(10, 0)
+        # one report in the window and one before it
+        other_product_id = uuid.uuid4().hex
+        _stock_report(self.case_id, other_product_id, 50, 90)
+        _stock_report(self.case_id, other_product_id, 40, 5)
+        # a single report
+        single_product_id = uuid.uuid4().hex
+        _stock_report(self.case_id, single_product_id, 30, 5)
+
+        keys = [(self.case_id, product_id, const.SECTION_TYPE_STOCK)
+                for product_id in (self.product_id, other_product_id, single_product_id, uuid.uuid4().hex)]
+        bulk = bulk_compute_consumption(keys, now, configuration=self._test_config)
+        self.assertEqual(set(keys), set(bulk))
+        for case_id, product_id, section_id in keys:
+            self.assertEqual(
+                compute_consumption(case_id, product_id, now, section_id, self._test_config),
+                bulk[(case_id, product_id, section_id)]
+            )
+        self.assertAlmostEqual(3., bulk[keys[0]])
+
+        _ten = lambda case_id, product_id: 10
+        config = ConsumptionConfiguration(min_periods=4, default_monthly_consumption_function=_ten)
+        bulk = bulk_compute_consumption_or_default(keys, now, configuration=config)
+        for case_id, product_id, section_id in keys:
+            self.assertEqual(
+                compute_consumption_or_default(case_id, product_id, now, section_id, config),
+                bulk[(case_id, product_id, section_id)]
+            )
@@ -1,6 +1,10 @@
+from decimal import Decimal
+import uuid
+from mock import patch
 from casexml.apps.stock import const
-from casexml.apps.stock.models import StockTransaction
-from casexml.apps.stock.tests import StockTestBase
+from casexml.apps.stock.models import StockReport, StockTransaction
+from casexml.apps.stock.tests.base import StockTestBase, _stock_report
+from casexml.apps.stock.tests.mock_consumption import ago
 
 
 
@@ -64,3 +68,87 @@ class InferredTransactionsTest(StockTestBase):
         self.assertEqual(rec.report, soh2.report)
         self.assertEqual(rec.case_id, soh2.case_id)
         self.assertEqual(rec.product_id, soh2.product_id)
+
+
+class BulkInferredTransactionsTest(StockTestBase):
+
+    def _report_transactions(self, case_id, amounts):
+        return [
+            StockTransaction(
+                section_id=const.SECTION_TYPE_STOCK,
+                type=type,
+                case_id=case_id,
+                product_id=product_id,
+                quantity=0,
+                stock_on_hand=Decimal(amount),
+            ) for product_id, type, amount in amounts
+        ]
+
+    def _ledger(self, case_id):
+        return [
+            (txn.report.date, txn.section_id, txn.product_id, txn.type, txn.subtype, txn.quantity, txn.stock_on_hand)
+            for txn in StockTransaction.objects.filter(case_id=case_id).order_by('report__date', 'pk')
+        ]
+
+    def testMatchesSignal(self):
+        signal_case_id = uuid.uuid4().hex
+        bulk_case_id = uuid.uuid4().hex
+        other_product_id = uuid.uuid4().hex
+        new_product_id = uuid.uuid4().hex
+        for case_id in (signal_case_id, bulk_case_id):
+            _stock_report(case_id, self.product_id, 25, 5)
+            _stock_report(case_id, other_product_id, 40, 5)
+
+        amounts = [
+            (self.product_id, const.TRANSACTION_TYPE_STOCKONHAND, 10),
+            (other_product_id, const.TRANSACTION_TYPE_STOCKONHAND, 40),
+            (new_product_id, const.TRANSACTION_TYPE_STOCKONHAND, 15),
+            (new_product_id, const.TRANSACTION_TYPE_STOCKONHAND, 20),
+            (other_product_id, const.TRANSACTION_TYPE_RECEIPTS, 45),
+            (other_product_id, const.TRANSACTION_TYPE_STOCKONHAND, 30),
+        ]
+        date = ago(0)
+        report = StockReport.objects.create(form_id=uuid.uuid4().hex, date=date, type=const.REPORT_TYPE_BALANCE)
+        for txn in self._report_transactions(signal_case_id, amounts):
+            txn.report = report
+            txn.save()
+        report = StockReport.objects.create(form_id=uuid.uuid4().hex, date=date, type=const.REPORT_TYPE_BALANCE)
+        report.bulk_save_transactions(self._report_transactions(bulk_case_id, amounts))
+
+        self.assertEqual(self._ledger(signal_case_id), self._ledger(bulk_case_id))
+        for product_id in (self.product_id, other_product_id, new_product_id):
+            self.assertEqual(
+                StockTransaction.latest(signal_case_id, const.SECTION_TYPE_STOCK, product_id).stock_on_hand,
+                StockTransaction.latest(bulk_case_id, const.SECTION_TYPE_STOCK, product_id).stock_on_hand,
+            )
+
+    def testBackdatedReport(self):
+        self._stock_report(25, 0)
+        report = StockReport.objects.create(form_id=uuid.uuid4().hex, date=ago(5), type=const.REPORT_TYPE_BALANCE)
+        report.bulk_save_transactions(self._report_transactions(self.case_id, [
+            (self.product_id, const.TRANSACTION_TYPE_STOCKONHAND, 10),
+        ]))
+        # the inferred transaction is based on the latest stock, and the
+        # backdated report doesn't replace it
+        (soh1, cons, soh2) = StockTransaction.objects.order_by('pk')
+        self.assertEqual(-15, cons.quantity)
+        self.assertEqual(soh1.pk, StockTransaction.latest(self.case_id, const.SECTION_TYPE_STOCK, self.product_id).pk)
+
+    def testNewerTransactionSavedConcurrently(self):
+        self._stock_report(25, 5)
+        report = StockReport.objects.create(form_id=uuid.uuid4().hex, date=ago(1), type=const.REPORT_TYPE_BALANCE)
+        bulk_create = StockTransaction.objects.bulk_create
+
+        def _bulk_create(transactions):
+            # another process saves a newer report for the ledger while
+            # this one is being saved
+            self._stock_report(40, 0)
+            return bulk_create(transactions)
+
+        with patch.object(StockTransaction.objects, 'bulk_create', _bulk_create):
+            report.bulk_save_transactions(self._report_transactions(self.case_id, [
+                (self.product_id, const.TRANSACTION_TYPE_STOCKONHAND, 10),
+            ]))
+        latest = StockTransaction.latest(self.case_id, const.SECTION_TYPE_STOCK, self.product_id)
+        self.assertEqual(40, latest.stock_on_hand)
+        self.assertEqual(ago(0).date(), latest.report.date.date())
@@ -0,0 +1,67 @@
+import uuid
+from casexml.apps.stock.models import StockTransaction, LatestStockState
+from casexml.apps.stock.tests.base import StockTestBase, _stock_report, _receipt_report
+from casexml.apps.stock import const
+
+
+class LatestTransactionsTest(StockTestBase):
+
+    def testEmpty(self):
+        self.assertEqual({}, StockTransaction.latest_for_cases([self.case_id]))
+
+    def testMatchesLatest(self):
+        other_case_id = uuid.uuid4().hex
+        other_product_id = uuid.uuid4().hex
+        self._stock_report(25, 5)
+        self._stock_report(10, 0)  # creates an inferred transaction on the same date
+        self._receipt_report(5, 0)
+        _stock_report(self.case_id, other_product_id, 40, 3)
+        _stock_report(other_case_id, self.product_id, 15, 2)
+        _receipt_report(other_case_id, self.product_id, 20, 1)
+
+        latest = StockTransaction.latest_for_cases([self.case_id, other_case_id])
+        self.assertEqual(set([self.case_id, other_case_id]), set(latest))
+        for case_id, product_id in [(self.case_id, self.product_id),
+                                    (self.case_id, other_product_id),
+                                    (other_case_id, self.product_id)]:
+            expected = StockTransaction.latest(case_id, const.SECTION_TYPE_STOCK, product_id)
+            self.assertEqual(expected.pk, latest[case_id][const.SECTION_TYPE_STOCK][product_id].pk)
+        self.assertEqual(2, len(latest[self.case_id][const.SECTION_TYPE_STOCK]))
+
+
+class LatestStockStateTest(StockTestBase):
+
+    def _state(self):
+        return LatestStockState.objects.get(case_id=self.case_id, section_id=const.SECTION_TYPE_STOCK,
+                                            product_id=self.product_id)
+
+    def _latest_from_history(self):
+        return StockTransaction._peer_qs(self.case_id, const.SECTION_TYPE_STOCK, self.product_id)[0]
+
+    def testUpdatedOnSave(self):
+        self._stock_report(25, 5)
+        self.assertEqual(25, self._state().stock_on_hand)
+        self._stock_report(10, 0)
+        state = self._state()
+        self.assertEqual(10, state.stock_on_hand)
+        self.assertEqual(self._latest_from_history().pk, state.transaction_id)
+        self.assertEqual(self._latest_from_history().report.date, state.last_report_date)
+
+    def testBackdatedReport(self):
+        self._stock_report(25, 0)
+        self._stock_report(10, 5)
+        state = self._state()
+        self.assertEqual(25, state.stock_on_hand)
+        self.assertEqual(self._latest_from_history().pk, state.transaction_id)
+
+    def testRebuiltOnDelete(self):
+        self._stock_report(25, 5)
+        self._stock_report(10, 0)
+        self._latest_from_history().report.delete()
+        state = self._state()
+        self.assertEqual(25, state.stock_on_hand)
+        self.assertEqual(self._latest_from_history().pk, state.transaction_id)
+
+        self._latest_from_history().report.delete()
+        self.assertEqual(0, LatestStockState.objects.filter(case_id=self.case_id).count())
+        self.assertEqual(None, StockTransaction.latest(self.case_id, const.SECTION_TYPE_STOCK, self.product_id))